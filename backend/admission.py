@@ -0,0 +1,231 @@
+import asyncio
+import io
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Tuple, Type
+
+from PIL import Image
+
+
+def leer_tamano(file_content: bytes) -> Tuple[int, int]:
+    """ Lee el tamaño de la imagen desde el header sin decodificar los pixeles """
+
+    # Image.open es perezoso: solo parsea el header hasta que se llama a load()
+    with Image.open(io.BytesIO(file_content)) as image:
+        return image.size
+
+
+class AdmisionRechazada(Exception):
+    """Se lanza cuando una solicitud no consigue presupuesto a tiempo"""
+
+
+def _por_congestion(error: BaseException, tipos: Tuple[Type[BaseException], ...]) -> bool:
+    """ Indica si el error (o alguno de los que lo causaron) es de uno de esos tipos """
+    while error is not None:
+        if isinstance(error, tipos):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class Cupo:
+    """Presupuesto ocupado por una solicitud admitida
+
+    Normalmente se devuelve al salir de admitir(). Si el trabajo sigue
+    corriendo después (un worker que no se puede interrumpir), retener()
+    pasa la devolución a quien llame la función que devuelve.
+    """
+
+    def __init__(self, control: "ControlAdmision", cost: float):
+        self._control = control
+        self._cost = cost
+        self.retenido = False
+        self._liberado = False
+
+    def retener(self) -> Callable[[], None]:
+        """ El cupo ya no se libera al salir de admitir(), sino al llamar la función devuelta """
+        self.retenido = True
+        return self.liberar
+
+    def liberar(self):
+        """ Devuelve el presupuesto una sola vez """
+        if not self._liberado:
+            self._liberado = True
+            self._control.liberar(self._cost)
+
+
+class ControlAdmision:
+    """Control de admisión por presupuesto de megapíxeles en vuelo
+
+    Cada solicitud se cobra según los megapíxeles decodificados de su imagen
+    contra un presupuesto global. La cola es FIFO estricta: una imagen grande
+    al frente no es adelantada por las chicas, así nunca queda postergada.
+    El límite de concurrencia se ajusta con AIMD comparando la latencia de
+    cada solicitud con un objetivo de costo fijo (arranque de Tesseract, etc.)
+    más un término por megapíxel. Un error de congestión (timeout, worker
+    caído) cuenta como latencia fuera de objetivo.
+    """
+
+    def __init__(
+        self,
+        budget_mp: float = 64.0,
+        max_concurrency: int = 8,
+        target_base_ms: float = 1500.0,
+        target_ms_per_mp: float = 400.0,
+        queue_timeout: float = 30.0,
+        min_cost_mp: float = 0.25,
+        congestion_errors: Tuple[Type[BaseException], ...] = (TimeoutError,),
+    ):
+        """ Inicializa el controlador con el presupuesto y los límites dados """
+        self.budget_mp = budget_mp
+        self.max_concurrency = max_concurrency
+        self.target_base_ms = target_base_ms
+        self.target_ms_per_mp = target_ms_per_mp
+        self.queue_timeout = queue_timeout
+        self.min_cost_mp = min_cost_mp
+        self.congestion_errors = congestion_errors
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.in_flight_mp = 0.0
+        self._waiters: Deque[Tuple[float, asyncio.Future]] = deque()
+        # Se incrementa en cada decremento: las solicitudes admitidas antes
+        # no vuelven a reducir el límite (a lo sumo un decremento por ventana)
+        self._epoch = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.decreases = 0
+
+    @classmethod
+    def desde_entorno(cls, **kwargs) -> "ControlAdmision":
+        """ Crea el controlador leyendo la configuración de variables de entorno """
+        return cls(
+            budget_mp=float(os.getenv("OCR_PIXEL_BUDGET_MP", "64")),
+            max_concurrency=int(os.getenv("OCR_MAX_CONCURRENCY", "8")),
+            target_base_ms=float(os.getenv("OCR_TARGET_BASE_MS", "1500")),
+            target_ms_per_mp=float(os.getenv("OCR_TARGET_MS_PER_MP", "400")),
+            queue_timeout=float(os.getenv("OCR_QUEUE_TIMEOUT", "30")),
+            **kwargs,
+        )
+
+    def costo(self, megapixeles: float) -> float:
+        """ Calcula el costo de una solicitud acotado al presupuesto global """
+        # Una imagen mayor al presupuesto se cobra como el presupuesto completo
+        # y corre sola, en lugar de quedar bloqueada para siempre
+        return min(max(megapixeles, self.min_cost_mp), self.budget_mp)
+
+    def _entra(self, cost: float) -> bool:
+        """ Indica si una solicitud con ese costo entra ahora mismo """
+        if self.in_flight == 0:
+            return True
+        return (
+            self.in_flight < int(self.limit)
+            and self.in_flight_mp + cost <= self.budget_mp
+        )
+
+    def _ocupar(self, cost: float):
+        self.in_flight += 1
+        self.in_flight_mp += cost
+        self.admitted += 1
+
+    def _despertar(self):
+        """ Admite solicitudes desde el frente de la cola mientras entren """
+        while self._waiters:
+            cost, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._entra(cost):
+                break
+            self._waiters.popleft()
+            self._ocupar(cost)
+            future.set_result(None)
+
+    async def adquirir(self, cost: float):
+        """ Espera en la cola hasta que haya presupuesto para la solicitud """
+        if not self._waiters and self._entra(cost):
+            self._ocupar(cost)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((cost, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Se otorgó justo cuando expiraba la espera: devolver el cupo
+                self.liberar(cost)
+            else:
+                future.cancel()
+                self._despertar()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected += 1
+            raise AdmisionRechazada(
+                f"Sin presupuesto de OCR disponible tras {self.queue_timeout}s"
+            )
+
+    def objetivo_ms(self, megapixeles: float) -> float:
+        """ Latencia aceptable para una imagen de ese tamaño """
+        return self.target_base_ms + self.target_ms_per_mp * megapixeles
+
+    def ajustar(self, latency: float, megapixeles: float, epoch: int):
+        """ Ajusta el límite de concurrencia (AIMD) con la latencia observada """
+        if latency * 1000 <= self.objetivo_ms(megapixeles):
+            # Incremento aditivo: ~ +1 por cada "ventana" completa de solicitudes
+            self.limit = min(self.limit + 1 / self.limit, float(self.max_concurrency))
+        else:
+            self.reducir(epoch)
+
+    def reducir(self, epoch: int):
+        """ Decremento multiplicativo, una sola vez por ventana """
+        if epoch == self._epoch:
+            self.limit = max(self.limit / 2, 1.0)
+            self.decreases += 1
+            self._epoch += 1
+
+    def liberar(self, cost: float):
+        """ Devuelve el presupuesto y admite a los que esperan """
+        self.in_flight -= 1
+        self.in_flight_mp = max(self.in_flight_mp - cost, 0.0)
+        self._despertar()
+
+    @asynccontextmanager
+    async def admitir(self, megapixeles: float):
+        """ Context manager que adquiere y libera el presupuesto de la solicitud """
+        cost = self.costo(megapixeles)
+        await self.adquirir(cost)
+        cupo = Cupo(self, cost)
+        epoch = self._epoch
+        start = time.perf_counter()
+        try:
+            yield cupo
+            self.ajustar(time.perf_counter() - start, megapixeles, epoch)
+        except Exception as e:
+            # Un timeout es la señal de congestión más clara; otros errores
+            # (imagen inválida, etc.) no dicen nada de la carga
+            if _por_congestion(e, self.congestion_errors):
+                self.reducir(epoch)
+            raise
+        finally:
+            if not cupo.retenido:
+                cupo.liberar()
+
+    def estadisticas(self) -> Dict:
+        """ Devuelve el estado actual del controlador """
+        return {
+            "budget_mp": self.budget_mp,
+            "in_flight": self.in_flight,
+            "in_flight_mp": round(self.in_flight_mp, 3),
+            "queued": sum(1 for _, f in self._waiters if not f.done()),
+            "concurrency_limit": round(self.limit, 2),
+            "max_concurrency": self.max_concurrency,
+            "target_base_ms": self.target_base_ms,
+            "target_ms_per_mp": self.target_ms_per_mp,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "aimd_decreases": self.decreases,
+        }
@@ -0,0 +1,359 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from itertools import combinations
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+PHASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = PHASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+NORMALIZED_SIZE = 64
+DHASH_WORDS = 4
+
+# Firma de contenido: la imagen binarizada a tamaño fijo (ancho, alto), comparada por bloques
+CONTENT_SIZE = (256, 384)
+CONTENT_BLOCK = 16
+
+
+class Huella(NamedTuple):
+    """Lo que se guarda de cada comprobante para reconocer un reenvío"""
+    phash: int
+    dhash: int
+    contenido: bytes
+
+
+def calcular_huella(gray: np.ndarray) -> Huella:
+    """ Calcula pHash (64 bits), dHash fino (256 bits) y firma de contenido
+
+    Toda imagen se reduce primero a tamaño fijo, así una copia redimensionada
+    o recomprimida produce los mismos valores. Solo esa miniatura se
+    convierte a float32, nunca la imagen completa. El pHash sirve para buscar
+    candidatos en el índice y el dHash los ordena; la firma de contenido
+    decide, porque dos comprobantes del mismo emisor que solo cambian el
+    importe tienen hashes casi iguales.
+    """
+    thumb = cv2.resize(gray, (NORMALIZED_SIZE, NORMALIZED_SIZE), interpolation=cv2.INTER_AREA)
+    thumb = thumb.astype(np.float32)
+
+    small = cv2.resize(thumb, (32, 32), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(small)[:8, :8].flatten()
+    # La mediana se calcula sin el coeficiente DC, que solo mide el brillo medio
+    phash = _bits_a_entero(dct > np.median(dct[1:]))
+
+    return Huella(phash, dhash_array(thumb), np.packbits(firma_contenido(gray)).tobytes())
+
+
+def dhash_array(gray: np.ndarray, width: int = 16, height: int = 16) -> int:
+    """ dHash de width x height bits: compara cada pixel con su vecino derecho """
+    fine = cv2.resize(gray, (width + 1, height), interpolation=cv2.INTER_AREA)
+    return _bits_a_entero((fine[:, 1:] > fine[:, :-1]).flatten())
+
+
+def firma_contenido(gray: np.ndarray) -> np.ndarray:
+    """ Máscara de tinta (1 = texto/trazo) de la imagen reducida a CONTENT_SIZE """
+    norm = cv2.resize(gray, CONTENT_SIZE, interpolation=cv2.INTER_AREA)
+    _, tinta = cv2.threshold(norm, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return tinta
+
+
+def diferencia_contenido(a: bytes, b: bytes) -> int:
+    """ Máximo de pixeles de tinta sin contraparte cercana en un bloque
+
+    Un pixel de tinta de una firma cuenta solo si en la otra no hay tinta a
+    1 pixel de distancia: el corrimiento de bordes al redimensionar o
+    recomprimir no suma, un dígito distinto sí, y queda concentrado en
+    su bloque.
+    """
+    width, height = CONTENT_SIZE
+    firmas = [
+        np.unpackbits(np.frombuffer(f, dtype=np.uint8))[:width * height].reshape(height, width)
+        for f in (a, b)
+    ]
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    cerca = [cv2.dilate(f, kernel) for f in firmas]
+    nueva = (firmas[0] & (1 - cerca[1])) | (firmas[1] & (1 - cerca[0]))
+    n = CONTENT_BLOCK
+    bloques = nueva[:height // n * n, :width // n * n].reshape(height // n, n, width // n, n)
+    return int(bloques.sum(axis=(1, 3)).max())
+
+
+def _bits_a_entero(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _palabras(dhash: int) -> np.ndarray:
+    """ dHash de 256 bits como 4 enteros de 64 bits, para comparar con NumPy """
+    return np.frombuffer(dhash.to_bytes(8 * DHASH_WORDS, "big"), dtype=">u8").astype(np.uint64)
+
+
+@lru_cache(maxsize=None)
+def _mascaras(max_flips: int) -> Tuple[int, ...]:
+    """ Máscaras XOR de CHUNK_BITS bits con hasta max_flips bits encendidos """
+    mascaras = [0]
+    for flips in range(1, max_flips + 1):
+        for posiciones in combinations(range(CHUNK_BITS), flips):
+            mascaras.append(sum(1 << p for p in posiciones))
+    return tuple(mascaras)
+
+
+class IndiceMultiHash:
+    """Índice de hashes de 64 bits con búsqueda por distancia de Hamming
+
+    Multi-index hashing: el hash se parte en 4 bloques de 16 bits, cada uno
+    con su propia tabla. Si dos hashes están a distancia <= r, por el
+    principio del palomar al menos un bloque difiere en <= r // 4 bits, así
+    que alcanza con enumerar esas pocas variantes por bloque en lugar de
+    recorrer todo el índice.
+
+    Los comprobantes de un mismo emisor tienen pHash casi iguales y caerían
+    todos en los mismos buckets: por eso las tablas guardan cada valor
+    distinto una sola vez, con la lista de posiciones que lo comparten. El
+    costo de la búsqueda depende de cuántos valores distintos hay cerca, no
+    de cuántos comprobantes hay.
+    """
+
+    def __init__(self):
+        self._posiciones: Dict[int, array] = {}
+        self._tablas: List[Dict[int, List[int]]] = [{} for _ in range(CHUNKS)]
+        self._total = 0
+
+    def __len__(self) -> int:
+        return self._total
+
+    def valores_distintos(self) -> int:
+        return len(self._posiciones)
+
+    def agregar(self, valor: int) -> int:
+        """ Agrega un hash y devuelve su posición en el índice """
+        posicion = self._total
+        self._total += 1
+        posiciones = self._posiciones.get(valor)
+        if posiciones is None:
+            posiciones = self._posiciones[valor] = array("q")
+            for i, tabla in enumerate(self._tablas):
+                tabla.setdefault((valor >> (i * CHUNK_BITS)) & CHUNK_MASK, []).append(valor)
+        posiciones.append(posicion)
+        return posicion
+
+    def buscar(self, valor: int, radio: int) -> List[Tuple[int, array]]:
+        """ Devuelve (distancia, posiciones) de los valores a distancia <= radio
+
+        Las posiciones de cada valor van en orden de inserción (array de int64).
+        """
+        max_flips = radio // CHUNKS
+        vistos = set()
+        resultado = []
+        for i, tabla in enumerate(self._tablas):
+            bloque = (valor >> (i * CHUNK_BITS)) & CHUNK_MASK
+            for mascara in _mascaras(max_flips):
+                for candidato in tabla.get(bloque ^ mascara, ()):
+                    if candidato in vistos:
+                        continue
+                    vistos.add(candidato)
+                    distancia = (valor ^ candidato).bit_count()
+                    if distancia <= radio:
+                        resultado.append((distancia, self._posiciones[candidato]))
+        resultado.sort(key=lambda r: r[0])
+        return resultado
+
+
+class IndiceDuplicados:
+    """Detección de comprobantes casi duplicados (reenviados/recomprimidos)
+
+    Guarda en SQLite las huellas y el resultado parseado de cada comprobante
+    procesado; al iniciar carga pHash y dHash en memoria (la firma de
+    contenido se lee de la base solo para los candidatos).
+
+    Umbrales por defecto medidos sobre el comprobante de ejemplo redimensionado
+    (0.5x a 1.6x) y recomprimido (JPEG calidad 30 a 90, PNG): el pHash difiere
+    en a lo sumo 2 bits, el dHash en a lo sumo 15 y la firma de contenido en
+    a lo sumo 1 pixel por bloque. Cambiar el importe, la fecha o un dígito
+    del número de operación da 13 o más pixeles en algún bloque.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        threshold: int = 4,
+        verify_threshold: int = 16,
+        content_tolerance: int = 4,
+        max_content_checks: int = 16,
+        max_candidates: int = 4096,
+    ):
+        """ Abre (o crea) la base y carga el índice en memoria """
+        self.threshold = threshold
+        self.verify_threshold = verify_threshold
+        self.content_tolerance = content_tolerance
+        self.max_content_checks = max_content_checks
+        self.max_candidates = max_candidates
+        self._indice = IndiceMultiHash()
+        self._ids: List[int] = []
+        self._dhashes = np.zeros((1024, DHASH_WORDS), dtype=np.uint64)
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.hits = 0
+        self.rejected_by_verify = 0
+        self.rejected_by_content = 0
+        self.lookup_seconds = 0.0
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS receipts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phash TEXT NOT NULL,
+                dhash TEXT NOT NULL,
+                content BLOB,
+                filename TEXT,
+                extracted_text TEXT,
+                parsed_data TEXT,
+                created_at TEXT NOT NULL
+            )"""
+        )
+        # Bases creadas antes de la firma de contenido: esas filas nunca se
+        # confirman como duplicado (content NULL)
+        columnas = {row[1] for row in self._db.execute("PRAGMA table_info(receipts)")}
+        if "content" not in columnas:
+            self._db.execute("ALTER TABLE receipts ADD COLUMN content BLOB")
+            self._db.commit()
+
+        # Los hashes se guardan en hex: SQLite no tiene enteros sin signo de 64 bits
+        for row_id, phash, dhash in self._db.execute("SELECT id, phash, dhash FROM receipts ORDER BY id"):
+            self._cargar(row_id, int(phash, 16), int(dhash, 16))
+
+    @classmethod
+    def desde_entorno(cls) -> Optional["IndiceDuplicados"]:
+        """ Crea el índice según variables de entorno (None si está deshabilitado) """
+        if os.getenv("OCR_DEDUP_ENABLED", "1") != "1":
+            return None
+        return cls(
+            db_path=os.getenv("OCR_DEDUP_DB", "dedup.sqlite3"),
+            threshold=int(os.getenv("OCR_DEDUP_THRESHOLD", "4")),
+            verify_threshold=int(os.getenv("OCR_DEDUP_VERIFY_THRESHOLD", "16")),
+            content_tolerance=int(os.getenv("OCR_DEDUP_CONTENT_TOLERANCE", "4")),
+        )
+
+    def _cargar(self, row_id: int, phash: int, dhash: int):
+        posicion = self._indice.agregar(phash)
+        if posicion == len(self._dhashes):
+            self._dhashes = np.concatenate([self._dhashes, np.zeros_like(self._dhashes)])
+        self._dhashes[posicion] = _palabras(dhash)
+        self._ids.append(row_id)
+
+    def _candidatos(self, huella: Huella) -> List[Tuple[int, int, int]]:
+        """ (row_id, distancia pHash, distancia dHash) de los más parecidos, mejores primero
+
+        Un layout frecuente puede aportar cientos de miles de candidatos con
+        el mismo pHash. Se revisan a lo sumo max_candidates, empezando por el
+        pHash más cercano y, dentro de cada valor, por los más recientes (un
+        reenvío suele llegar poco después del original). Si el original quedó
+        afuera, solo se pierde el atajo: la solicitud pasa por el OCR.
+        """
+        bloques = []
+        restantes = self.max_candidates
+        for distancia, posiciones in self._indice.buscar(huella.phash, self.threshold):
+            if restantes <= 0:
+                break
+            recientes = np.frombuffer(posiciones, dtype=np.int64)[-restantes:]
+            bloques.append((distancia, recientes))
+            restantes -= len(recientes)
+        if not bloques:
+            return []
+
+        # El dHash se compara de una vez con NumPy y solo los mejores pasan a la firma
+        posiciones = np.concatenate([p for _, p in bloques])
+        distancias = np.repeat([d for d, _ in bloques], [len(p) for _, p in bloques])
+        finas = np.bitwise_count(self._dhashes[posiciones] ^ _palabras(huella.dhash)).sum(axis=1)
+
+        validos = finas <= self.verify_threshold
+        self.rejected_by_verify += int((~validos).sum())
+        posiciones, distancias, finas = posiciones[validos], distancias[validos], finas[validos]
+        puntaje = distancias + finas
+        if len(puntaje) > self.max_content_checks:
+            mejores = np.argpartition(puntaje, self.max_content_checks)[:self.max_content_checks]
+        else:
+            mejores = np.arange(len(puntaje))
+        orden = mejores[np.argsort(puntaje[mejores], kind="stable")]
+        return [(self._ids[posiciones[i]], int(distancias[i]), int(finas[i])) for i in orden]
+
+    def buscar(self, huella: Huella) -> Optional[Dict]:
+        """ Busca un comprobante previo con el mismo contenido y devuelve su resultado """
+        start = time.perf_counter()
+        match = None
+        with self._lock:
+            candidatos = self._candidatos(huella)
+            if candidatos:
+                marcas = ",".join("?" * len(candidatos))
+                contenidos = dict(self._db.execute(
+                    f"SELECT id, content FROM receipts WHERE id IN ({marcas})",
+                    [row_id for row_id, _, _ in candidatos],
+                ))
+            for row_id, distancia, distancia_fina in candidatos:
+                contenido = contenidos.get(row_id)
+                if contenido is not None:
+                    diferencia = diferencia_contenido(huella.contenido, contenido)
+                    if diferencia <= self.content_tolerance:
+                        match = (row_id, distancia, distancia_fina, diferencia)
+                        break
+                self.rejected_by_content += 1
+            self.lookups += 1
+            self.lookup_seconds += time.perf_counter() - start
+
+            if match is None:
+                return None
+            self.hits += 1
+
+            row_id, distancia, distancia_fina, diferencia = match
+            filename, extracted_text, parsed_data, created_at = self._db.execute(
+                "SELECT filename, extracted_text, parsed_data, created_at FROM receipts WHERE id = ?",
+                (row_id,),
+            ).fetchone()
+        return {
+            "match_id": row_id,
+            "distance": distancia,
+            "verify_distance": distancia_fina,
+            "content_difference": diferencia,
+            "filename": filename,
+            "extracted_text": extracted_text,
+            "parsed_data": json.loads(parsed_data),
+            "first_seen": created_at,
+        }
+
+    def agregar(self, huella: Huella, filename: str, extracted_text: str, parsed_data: Dict) -> int:
+        """ Guarda un comprobante procesado y lo suma al índice """
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO receipts (phash, dhash, content, filename, extracted_text, parsed_data, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (f"{huella.phash:016x}", f"{huella.dhash:064x}", huella.contenido, filename,
+                 extracted_text, json.dumps(parsed_data), datetime.now().isoformat()),
+            )
+            self._db.commit()
+            self._cargar(cursor.lastrowid, huella.phash, huella.dhash)
+        return cursor.lastrowid
+
+    def estadisticas(self) -> Dict:
+        """ Devuelve el tamaño del índice y las métricas de búsqueda """
+        return {
+            "entries": len(self._indice),
+            "distinct_phashes": self._indice.valores_distintos(),
+            "threshold": self.threshold,
+            "verify_threshold": self.verify_threshold,
+            "content_tolerance": self.content_tolerance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "rejected_by_verify": self.rejected_by_verify,
+            "rejected_by_content": self.rejected_by_content,
+            "avg_lookup_us": round(1e6 * self.lookup_seconds / self.lookups, 1) if self.lookups else None,
+        }
@@ -0,0 +1,302 @@
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from dedup import dhash_array
+from profiling import span
+
+FIELD_PADDING = 24
+MIN_FIELD_HEIGHT = 64
+ANCHOR_HASH_SIZE = (16, 16)
+ANCHOR_MAX_DISTANCE = 10
+
+
+def _recortar(gray: np.ndarray, region: List[float]) -> np.ndarray:
+    """ Recorta una región relativa [x, y, w, h] (0..1) de la imagen """
+    height, width = gray.shape[:2]
+    x, y, w, h = region
+    x0, y0 = int(x * width), int(y * height)
+    x1, y1 = min(int((x + w) * width), width), min(int((y + h) * height), height)
+    return gray[y0:y1, x0:x1]
+
+
+def _parsear_importe(texto: str) -> Optional[float]:
+    """ Convierte "$ 1.234,56" o "$ 400" a float (formato argentino) """
+    numero = re.sub(r"[^\d.,]", "", texto)
+    if not numero:
+        return None
+    if "," in numero:
+        numero = numero.replace(".", "").replace(",", ".")
+    elif re.search(r"\.\d{3}$", numero):
+        # Un punto seguido de tres dígitos es separador de miles
+        numero = numero.replace(".", "")
+    try:
+        return float(numero)
+    except ValueError:
+        return None
+
+
+class Plantilla:
+    """Layout conocido de un emisor con su huella y sus regiones de campos"""
+
+    def __init__(self, data: Dict, base_dir: str):
+        """ Construye la plantilla a partir de su definición en el archivo de datos """
+        self.id = data["id"]
+        self.issuer = data.get("issuer")
+        self.aspect_ratio = tuple(data.get("aspect_ratio", (0, float("inf"))))
+        self.anchor = data.get("anchor")
+        self.keywords = data.get("keywords")
+        self.fields = data["fields"]
+
+        for field in self.fields:
+            if any(c.isspace() for c in field.get("whitelist", "")):
+                raise ValueError(f"Plantilla {self.id}: la whitelist de {field['name']} no admite espacios")
+
+        # Huella visual: dHash de la región ancla, precalculado o desde la imagen de referencia
+        self.anchor_hash = None
+        if self.anchor:
+            # La región debe tener contenido propio (el logo): en una zona casi
+            # vacía el hash tiene pocos bits y una imagen en blanco también coincide
+            self.anchor_size = tuple(self.anchor.get("hash_size", ANCHOR_HASH_SIZE))
+            self.anchor_max_distance = self.anchor.get("max_distance", ANCHOR_MAX_DISTANCE)
+            if "hash" in self.anchor:
+                self.anchor_hash = int(self.anchor["hash"], 16)
+            else:
+                path = os.path.join(base_dir, data["reference_image"])
+                reference = np.asarray(Image.open(path).convert("L"))
+                self.anchor_hash = dhash_array(_recortar(reference, self.anchor["region"]), *self.anchor_size)
+
+        if self.anchor_hash is None and not self.keywords:
+            raise ValueError(f"Plantilla {self.id}: requiere 'anchor' o 'keywords'")
+
+    def aspecto_valido(self, gray: np.ndarray) -> bool:
+        height, width = gray.shape[:2]
+        return self.aspect_ratio[0] <= height / width <= self.aspect_ratio[1]
+
+
+class IndicePlantillas:
+    """Camino rápido para layouts conocidos (Mercado Pago, bancos, AFIP)
+
+    Las plantillas se definen en un archivo JSON. Si la imagen coincide con
+    una, solo se hace OCR de los recortes de cada campo, agrupados en un
+    lienzo por whitelist para usar una sola llamada a Tesseract por grupo.
+    Si no coincide o falta un campo requerido, se usa el pipeline completo.
+    """
+
+    def __init__(self, plantillas: List[Plantilla]):
+        """ Precalcula el índice de huellas visuales agrupado por región ancla """
+        self.plantillas = plantillas
+        self._por_ancla: Dict[Tuple[Tuple[float, ...], Tuple[int, int]], List[Plantilla]] = {}
+        self._textuales: List[Plantilla] = []
+        for plantilla in plantillas:
+            if plantilla.anchor_hash is not None:
+                clave = (tuple(plantilla.anchor["region"]), plantilla.anchor_size)
+                self._por_ancla.setdefault(clave, []).append(plantilla)
+            else:
+                self._textuales.append(plantilla)
+
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.matches: Dict[str, int] = {p.id: 0 for p in plantillas}
+        self.fallbacks = 0
+        self.misses = 0
+        self.match_seconds_lost = 0.0
+        self.template_seconds = 0.0
+        self.full_runs = 0
+        self.full_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    @classmethod
+    def desde_archivo(cls, path: str) -> "IndicePlantillas":
+        """ Carga las plantillas desde el archivo JSON """
+        with open(path) as f:
+            data = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        return cls([Plantilla(t, base_dir) for t in data["templates"]])
+
+    @classmethod
+    def desde_entorno(cls) -> Optional["IndicePlantillas"]:
+        """ Crea el índice según variables de entorno (None si está deshabilitado) """
+        if os.getenv("OCR_TEMPLATES_ENABLED", "1") != "1":
+            return None
+        path = os.getenv("OCR_TEMPLATES_FILE", "layout_templates.json")
+        if not os.path.exists(path):
+            print(f"Archivo de plantillas no encontrado: {path}")
+            return None
+        return cls.desde_archivo(path)
+
+    def buscar(self, gray: np.ndarray) -> Optional[Plantilla]:
+        """ Devuelve la plantilla cuyo layout coincide con la imagen, si hay una """
+        with span("template_match"):
+            with self._lock:
+                self.attempts += 1
+
+            mejor = None
+            for (region, size), plantillas in self._por_ancla.items():
+                candidatas = [p for p in plantillas if p.aspecto_valido(gray)]
+                if not candidatas:
+                    continue
+                recorte = _recortar(gray, list(region))
+                # Una imagen diminuta deja un recorte vacío o más chico que la grilla del hash
+                if recorte.shape[0] < size[1] or recorte.shape[1] < size[0] + 1:
+                    continue
+                valor = dhash_array(recorte, *size)
+                for plantilla in candidatas:
+                    distancia = (valor ^ plantilla.anchor_hash).bit_count()
+                    if distancia <= plantilla.anchor_max_distance:
+                        if mejor is None or distancia < mejor[0]:
+                            mejor = (distancia, plantilla)
+            if mejor is not None:
+                return mejor[1]
+
+            # Huella textual: OCR rápido de una región chica buscando palabras clave
+            for plantilla in self._textuales:
+                if not plantilla.aspecto_valido(gray):
+                    continue
+                recorte = _recortar(gray, plantilla.keywords["region"])
+                if recorte.size == 0:
+                    continue
+                try:
+                    texto = pytesseract.image_to_string(recorte, config='--oem 3 --psm 6 -l spa+eng').lower()
+                except Exception as e:
+                    print(f"Error reading keywords for template {plantilla.id}: {str(e)}")
+                    continue
+                if any(k.lower() in texto for k in plantilla.keywords["any"]):
+                    return plantilla
+            return None
+
+    def _ocr_grupo(self, gray: np.ndarray, fields: List[Dict], whitelist: str) -> Dict[str, str]:
+        """ Arma un lienzo con los recortes de los campos y hace una sola pasada de OCR """
+        recortes = []
+        for field in fields:
+            recorte = _recortar(gray, field["region"])
+            if recorte.shape[0] < MIN_FIELD_HEIGHT:
+                escala = MIN_FIELD_HEIGHT / recorte.shape[0]
+                recorte = cv2.resize(recorte, None, fx=escala, fy=escala, interpolation=cv2.INTER_CUBIC)
+            _, recorte = cv2.threshold(recorte, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            recortes.append(recorte)
+
+        ancho = max(r.shape[1] for r in recortes) + 2 * FIELD_PADDING
+        alto = sum(r.shape[0] + FIELD_PADDING for r in recortes) + FIELD_PADDING
+        lienzo = np.full((alto, ancho), 255, dtype=np.uint8)
+        franjas = []
+        y = FIELD_PADDING
+        for recorte in recortes:
+            h, w = recorte.shape
+            lienzo[y:y + h, FIELD_PADDING:FIELD_PADDING + w] = recorte
+            franjas.append((y - FIELD_PADDING // 2, y + h + FIELD_PADDING // 2))
+            y += h + FIELD_PADDING
+
+        config = '--oem 3 --psm 6 -l spa+eng'
+        if whitelist:
+            config += f' -c tessedit_char_whitelist={whitelist}'
+        data = pytesseract.image_to_data(lienzo, config=config, output_type=pytesseract.Output.DICT)
+
+        # Cada palabra se asigna al campo cuya franja contiene su centro vertical
+        palabras: Dict[str, List[str]] = {field["name"]: [] for field in fields}
+        for text, top, height in zip(data["text"], data["top"], data["height"]):
+            if not text.strip():
+                continue
+            centro = top + height / 2
+            for field, (y0, y1) in zip(fields, franjas):
+                if y0 <= centro < y1:
+                    palabras[field["name"]].append(text.strip())
+                    break
+        return {name: " ".join(words) for name, words in palabras.items()}
+
+    def extraer(self, gray: np.ndarray, plantilla: Plantilla) -> Optional[Dict]:
+        """ Extrae los campos de la plantilla; None si falta un campo requerido """
+        with span("template_fields"):
+            grupos: Dict[str, List[Dict]] = {}
+            for field in plantilla.fields:
+                grupos.setdefault(field.get("whitelist", ""), []).append(field)
+
+            crudos: Dict[str, str] = {}
+            for whitelist, fields in grupos.items():
+                crudos.update(self._ocr_grupo(gray, fields, whitelist))
+
+            parsed_data = {
+                "date": None,
+                "total": None,
+                "invoice_number": None,
+                "company": plantilla.issuer,
+                "items": [],
+                "fields": {},
+            }
+            for field in plantilla.fields:
+                valor = self._valor_campo(field, crudos[field["name"]])
+                if valor is None and field.get("required"):
+                    return None
+                parsed_data["fields"][field["name"]] = valor
+                if field.get("maps_to"):
+                    parsed_data[field["maps_to"]] = valor
+
+            texto = "\n".join(f"{name}: {raw}" for name, raw in crudos.items())
+            return {"template": plantilla.id, "extracted_text": texto, "parsed_data": parsed_data}
+
+    def _valor_campo(self, field: Dict, crudo: str):
+        """ Aplica el patrón y el tipo del campo al texto reconocido """
+        if not crudo:
+            return None
+        if field.get("pattern"):
+            match = re.search(field["pattern"], crudo, re.IGNORECASE)
+            if not match:
+                return None
+            crudo = match.group(1) if match.groups() else match.group(0)
+
+        tipo = field.get("type", "text")
+        if tipo == "amount":
+            return _parsear_importe(crudo)
+        if tipo == "digits":
+            return re.sub(r"\D", "", crudo) or None
+        return crudo
+
+    def registrar_match(self, template_id: str, seconds: float):
+        """ Cuenta un match y estima el tiempo ahorrado contra el pipeline completo """
+        with self._lock:
+            self.matches[template_id] += 1
+            self.template_seconds += seconds
+            if self.full_runs:
+                self.saved_seconds += self.full_seconds / self.full_runs - seconds
+
+    def registrar_fallback(self, seconds: float):
+        """ Una plantilla coincidió pero faltaron campos: ese tiempo se perdió """
+        with self._lock:
+            self.fallbacks += 1
+            self.saved_seconds -= seconds
+
+    def registrar_sin_match(self, seconds: float):
+        """ Ninguna plantilla coincidió: la búsqueda (incluido el OCR de palabras clave) se perdió """
+        with self._lock:
+            self.misses += 1
+            self.match_seconds_lost += seconds
+            self.saved_seconds -= seconds
+
+    def registrar_completo(self, seconds: float):
+        """ Registra la duración del pipeline completo para estimar el ahorro """
+        with self._lock:
+            self.full_runs += 1
+            self.full_seconds += seconds
+
+    def estadisticas(self) -> Dict:
+        """ Devuelve la tasa de match y el tiempo ahorrado estimado """
+        total_matches = sum(self.matches.values())
+        return {
+            "templates": [p.id for p in self.plantillas],
+            "attempts": self.attempts,
+            "matches": self.matches,
+            "match_rate": round(total_matches / self.attempts, 3) if self.attempts else None,
+            "fallbacks": self.fallbacks,
+            "misses": self.misses,
+            "avg_miss_ms": round(1000 * self.match_seconds_lost / self.misses, 1) if self.misses else None,
+            "avg_template_ms": round(1000 * self.template_seconds / total_matches, 1) if total_matches else None,
+            "avg_full_pipeline_ms": round(1000 * self.full_seconds / self.full_runs, 1) if self.full_runs else None,
+            "estimated_saved_s": round(self.saved_seconds, 3),
+        }
@@ -0,0 +1,428 @@
+"""Generador de carga end-to-end para main_ocr.py -> ocr_service.py
+
+Levanta ambos servicios en puertos efímeros, reproduce un corpus de imágenes
+contra /upload a una tasa fija (--rate) o con concurrencia fija (--concurrency)
+y escribe un reporte JSON con throughput, percentiles de latencia, errores y
+consumo de CPU/RSS de cada servidor.
+
+Ejemplos:
+    uv run python loadtest.py --concurrency 4 --duration 30
+    uv run python loadtest.py --rate 2 --duration 60 --output report.json
+    uv run python loadtest.py --target http://localhost:8000 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def puerto_libre() -> int:
+    """ Pide al sistema operativo un puerto TCP libre """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cargar_corpus(paths: List[str]) -> List[tuple]:
+    """ Carga en memoria las imágenes del corpus (archivos o directorios) """
+    archivos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for nombre in sorted(os.listdir(path)):
+                if nombre.lower().endswith(IMAGE_EXTENSIONS):
+                    archivos.append(os.path.join(path, nombre))
+        else:
+            archivos.append(path)
+
+    corpus = []
+    for archivo in archivos:
+        with open(archivo, "rb") as f:
+            corpus.append((os.path.basename(archivo), f.read()))
+    if not corpus:
+        raise Exception(f"No se encontraron imágenes en: {paths}")
+    return corpus
+
+
+def percentil(valores: List[float], p: float) -> Optional[float]:
+    """ Percentil por rango más cercano sobre una lista ya ordenada """
+    if not valores:
+        return None
+    indice = max(int(round(p / 100 * len(valores))) - 1, 0)
+    return valores[min(indice, len(valores) - 1)]
+
+
+def _descendientes(pid: int) -> List[int]:
+    """ pid y todos sus descendientes vivos, según /proc/<pid>/task/*/children """
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        try:
+            for tid in os.listdir(f"/proc/{pids[i]}/task"):
+                with open(f"/proc/{pids[i]}/task/{tid}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except (OSError, ValueError):
+            pass
+        i += 1
+    return pids
+
+
+class MonitorProceso:
+    """Muestrea CPU y RSS del árbol de procesos de un servidor leyendo /proc (solo Linux)
+
+    Incluye los hijos (workers del pool de OCR y procesos de Tesseract), que es
+    donde se gasta casi toda la CPU del servicio OCR.
+    """
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.rss_peak = 0
+        self.rss_last = 0
+        self.processes_peak = 0
+        self.cpu_start = self._cpu_arbol(_descendientes(pid))
+        self.cpu_end = self.cpu_start
+
+    def _cpu_seconds(self, pid: int) -> Optional[float]:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # El nombre del proceso puede tener espacios: cortar tras ')'
+                campos = f.read().rsplit(")", 1)[1].split()
+            # utime, stime, cutime y cstime son los campos 14-17 (índices 11-14 tras el nombre);
+            # cutime/cstime suman los hijos ya terminados (cada llamada a Tesseract)
+            return sum(int(c) for c in campos[11:15]) / CLK_TCK
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _rss_bytes(self, pid: int) -> Optional[int]:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for linea in f:
+                    if linea.startswith("VmRSS:"):
+                        return int(linea.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def muestrear(self):
+        pids = _descendientes(self.pid)
+        # La suma de RSS cuenta dos veces las páginas compartidas entre procesos
+        rss = sum(r for r in (self._rss_bytes(p) for p in pids) if r is not None)
+        if rss:
+            self.rss_last = rss
+            self.rss_peak = max(self.rss_peak, rss)
+            self.processes_peak = max(self.processes_peak, len(pids))
+        cpu = self._cpu_arbol(pids)
+        if cpu is not None:
+            self.cpu_end = max(cpu, self.cpu_end or 0.0)
+
+    def _cpu_arbol(self, pids: List[int]) -> Optional[float]:
+        cpus = [c for c in (self._cpu_seconds(p) for p in pids) if c is not None]
+        return sum(cpus) if cpus else None
+
+    def reporte(self, duracion: float) -> Dict:
+        if self.cpu_start is None:
+            return {"pid": self.pid, "available": False}
+        cpu = self.cpu_end - self.cpu_start
+        return {
+            "pid": self.pid,
+            "available": True,
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent_avg": round(100 * cpu / duracion, 1) if duracion else None,
+            "rss_mb_peak": round(self.rss_peak / 2**20, 1),
+            "rss_mb_end": round(self.rss_last / 2**20, 1),
+            "processes_peak": self.processes_peak,
+        }
+
+
+class Servicios:
+    """Levanta ocr_service.py y main_ocr.py localmente en puertos efímeros"""
+
+    def __init__(self, log_dir: Optional[str] = None, dedup: bool = False):
+        self.ocr_port = puerto_libre()
+        self.gateway_port = puerto_libre()
+        self.ocr_url = f"http://127.0.0.1:{self.ocr_port}"
+        self.gateway_url = f"http://127.0.0.1:{self.gateway_port}"
+        self.log_dir = log_dir
+        self.dedup = dedup
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="loadtest-")
+        self.procesos: Dict[str, subprocess.Popen] = {}
+        self._logs = []
+
+    def _lanzar(self, nombre: str, modulo: str, port: int, env: Dict):
+        salida = subprocess.DEVNULL
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+            salida = open(os.path.join(self.log_dir, f"{nombre}.log"), "wb")
+            self._logs.append(salida)
+        self.procesos[nombre] = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", modulo, "--host", "127.0.0.1",
+             "--port", str(port), "--log-level", "warning"],
+            cwd=BASE_DIR,
+            env=env,
+            stdout=salida,
+            stderr=subprocess.STDOUT,
+        )
+
+    async def _esperar_salud(self, url: str, timeout: float = 30.0):
+        limite = time.monotonic() + timeout
+        ultimo = None
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            while time.monotonic() < limite:
+                try:
+                    response = await client.get(f"{url}/health")
+                    # El servicio OCR responde 200 con "unhealthy" si falta Tesseract
+                    if response.status_code == 200:
+                        ultimo = response.json()
+                        if ultimo.get("status") == "healthy":
+                            return
+                except (httpx.HTTPError, ValueError):
+                    pass
+                await asyncio.sleep(0.2)
+        if ultimo is not None:
+            raise Exception(f"El servicio en {url} no está sano: {ultimo}")
+        raise Exception(f"El servicio en {url} no respondió a /health en {timeout}s")
+
+    async def iniciar(self):
+        env = dict(os.environ)
+        # Con un corpus fijo, el índice de duplicados convertiría toda repetición
+        # en un acierto de cache; solo se activa con --dedup, sobre una base temporal
+        env_ocr = dict(
+            env,
+            OCR_DEDUP_ENABLED="1" if self.dedup else "0",
+            OCR_DEDUP_DB=os.path.join(self._tmp_dir.name, "dedup.sqlite3"),
+        )
+        self._lanzar("ocr", "ocr_service:app", self.ocr_port, env_ocr)
+        env_gateway = dict(env, OCR_SERVICE_URL=self.ocr_url)
+        self._lanzar("gateway", "main_ocr:app", self.gateway_port, env_gateway)
+        await self._esperar_salud(self.ocr_url)
+        await self._esperar_salud(self.gateway_url)
+
+    def detener(self):
+        for proceso in self.procesos.values():
+            proceso.terminate()
+        for proceso in self.procesos.values():
+            try:
+                proceso.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proceso.kill()
+        for log in self._logs:
+            log.close()
+        self._tmp_dir.cleanup()
+
+
+def clasificar_error(response: httpx.Response) -> str:
+    """ Tipo de error a partir del detalle que arma el gateway
+
+    El gateway convierte toda falla del servicio OCR en un 500; el código
+    original (503 de admisión, 504 de timeout, 400 de imagen inválida)
+    solo queda en el texto del detalle.
+    """
+    try:
+        detalle = str(response.json().get("detail", ""))
+    except ValueError:
+        detalle = response.text
+    match = re.search(r"Error en servicio OCR: (\d{3})", detalle)
+    if match:
+        return f"ocr_{match.group(1)}"
+    if "Timeout al procesar" in detalle:
+        return "gateway_timeout"
+    if "No se puede conectar" in detalle:
+        return "ocr_unreachable"
+    return f"http_{response.status_code}"
+
+
+class GeneradorCarga:
+    """Reproduce el corpus contra el endpoint /upload y registra resultados"""
+
+    def __init__(self, url: str, corpus: List[tuple], timeout: float):
+        self.url = f"{url}/upload"
+        self.corpus = corpus
+        self.timeout = timeout
+        self.latencias: List[float] = []
+        self.errores: Counter = Counter()
+        self.enviados = 0
+
+    def _siguiente(self) -> tuple:
+        imagen = self.corpus[self.enviados % len(self.corpus)]
+        self.enviados += 1
+        return imagen
+
+    async def _enviar(self, client: httpx.AsyncClient, inicio: Optional[float] = None):
+        filename, content = self._siguiente()
+        # En modo tasa la latencia se mide desde el instante programado,
+        # para no ocultar la espera cuando el sistema se atrasa
+        inicio = inicio if inicio is not None else time.perf_counter()
+        try:
+            response = await client.post(
+                self.url, files={"file": (filename, content, "image/jpeg")}
+            )
+            if response.status_code == 200:
+                self.latencias.append(time.perf_counter() - inicio)
+            else:
+                self.errores[clasificar_error(response)] += 1
+        except httpx.TimeoutException:
+            self.errores["timeout"] += 1
+        except httpx.HTTPError as e:
+            self.errores[type(e).__name__] += 1
+
+    async def por_concurrencia(self, concurrency: int, duration: float, total: Optional[int]):
+        """ Modo cerrado: N clientes envían la siguiente solicitud al terminar la anterior """
+        limite = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=concurrency)
+
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            async def cliente():
+                while time.perf_counter() < limite and (total is None or self.enviados < total):
+                    await self._enviar(client)
+
+            await asyncio.gather(*(cliente() for _ in range(concurrency)))
+
+    async def por_tasa(self, rate: float, duration: float, total: Optional[int]):
+        """ Modo abierto: lanza solicitudes a tasa fija sin esperar respuestas """
+        intervalo = 1 / rate
+        inicio = time.perf_counter()
+        tareas = []
+
+        async with httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=None)) as client:
+            n = 0
+            while True:
+                programado = inicio + n * intervalo
+                if programado - inicio >= duration or (total is not None and n >= total):
+                    break
+                espera = programado - time.perf_counter()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                tareas.append(asyncio.create_task(self._enviar(client, programado)))
+                n += 1
+            await asyncio.gather(*tareas)
+
+    def reporte(self, duracion: float) -> Dict:
+        latencias = sorted(self.latencias)
+        ok = len(latencias)
+        ms = lambda v: round(v * 1000, 1) if v is not None else None
+        return {
+            "requests": self.enviados,
+            "ok": ok,
+            "errors": sum(self.errores.values()),
+            "error_breakdown": dict(self.errores),
+            "throughput_rps": round(ok / duracion, 3) if duracion else None,
+            "latency_ms": {
+                "mean": ms(sum(latencias) / ok) if ok else None,
+                "p50": ms(percentil(latencias, 50)),
+                "p90": ms(percentil(latencias, 90)),
+                "p95": ms(percentil(latencias, 95)),
+                "p99": ms(percentil(latencias, 99)),
+                "max": ms(latencias[-1] if latencias else None),
+            },
+        }
+
+
+async def muestrear_servidores(monitores: Dict[str, MonitorProceso], intervalo: float = 0.5):
+    while True:
+        for monitor in monitores.values():
+            monitor.muestrear()
+        await asyncio.sleep(intervalo)
+
+
+async def ejecutar(args) -> Dict:
+    corpus = cargar_corpus(args.corpus)
+    servicios = None
+    monitores: Dict[str, MonitorProceso] = {}
+    url = args.target
+    ocr_url = None
+
+    try:
+        if url is None:
+            servicios = Servicios(log_dir=args.log_dir, dedup=args.dedup)
+            await servicios.iniciar()
+            url = servicios.gateway_url
+            ocr_url = servicios.ocr_url
+            monitores = {n: MonitorProceso(p.pid) for n, p in servicios.procesos.items()}
+
+        generador = GeneradorCarga(url, corpus, args.timeout)
+        muestreo = asyncio.create_task(muestrear_servidores(monitores))
+
+        inicio = time.perf_counter()
+        if args.rate:
+            await generador.por_tasa(args.rate, args.duration, args.requests)
+        else:
+            await generador.por_concurrencia(args.concurrency, args.duration, args.requests)
+        duracion = time.perf_counter() - inicio
+
+        muestreo.cancel()
+        for monitor in monitores.values():
+            monitor.muestrear()
+
+        reporte = {
+            "timestamp": datetime.now().isoformat(),
+            "target": url,
+            "mode": "rate" if args.rate else "concurrency",
+            "config": {
+                "rate": args.rate,
+                "concurrency": None if args.rate else args.concurrency,
+                "duration_s": args.duration,
+                "max_requests": args.requests,
+                "corpus_size": len(corpus),
+            },
+            "duration_s": round(duracion, 3),
+            **generador.reporte(duracion),
+            "servers": {n: m.reporte(duracion) for n, m in monitores.items()},
+        }
+
+        if ocr_url:
+            try:
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    reporte["ocr_admission"] = (await client.get(f"{ocr_url}/admission")).json()
+            except httpx.HTTPError:
+                pass
+
+        return reporte
+
+    finally:
+        if servicios:
+            servicios.detener()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga gateway + servicio OCR")
+    parser.add_argument("corpus", nargs="*", default=[os.path.join(BASE_DIR, "images")],
+                        help="Imágenes o directorios a reproducir (default: images/)")
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument("--rate", type=float, help="Solicitudes por segundo (modo abierto)")
+    modo.add_argument("--concurrency", type=int, default=4, help="Clientes concurrentes (modo cerrado)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duración en segundos")
+    parser.add_argument("--requests", type=int, help="Corta tras enviar esta cantidad de solicitudes")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout por solicitud")
+    parser.add_argument("--target", help="URL de un gateway ya levantado (no lanza servicios)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Activa el índice de duplicados del servicio OCR (base temporal)")
+    parser.add_argument("--log-dir", help="Directorio para los logs de los servicios lanzados")
+    parser.add_argument("--output", help="Archivo donde escribir el reporte JSON (default: stdout)")
+    args = parser.parse_args()
+
+    reporte = asyncio.run(ejecutar(args))
+    salida = json.dumps(reporte, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(salida + "\n")
+    else:
+        print(salida)
+
+
+if __name__ == "__main__":
+    main()
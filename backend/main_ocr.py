@@ -1,6 +1,7 @@
 from typing import Annotated
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from services.ProcesadorFacturaOCR import ProcesadorFacturaOCR
+from profiling import Perfilador, span
 import os
 import asyncio
 
@@ -13,6 +14,9 @@ app = FastAPI(
 OCR_SERVICE_URL = os.getenv("OCR_SERVICE_URL", "http://localhost:8001")
 procesadorFactura = ProcesadorFacturaOCR(OCR_SERVICE_URL)
 
+# Perfilado bajo demanda; el id del perfil se propaga al servicio OCR
+Perfilador("main-api").instalar(app)
+
 @app.get("/")
 async def root():
     """Endpoint raíz con información del servicio"""
@@ -60,7 +64,8 @@ async def upload_invoice(file: UploadFile = File(...)):
         file_content = await file.read()
         
         # Procesar con el servicio OCR
-        resultado = await procesadorFactura.procesar_archivo(file_content, file.filename)
+        with span("ocr_service_call"):
+            resultado = await procesadorFactura.procesar_archivo(file_content, file.filename)
         
         return resultado
         
@@ -78,7 +83,8 @@ async def extract_text_only(file: UploadFile = File(...)):
 
     try:
         file_content = await file.read()
-        texto = await procesadorFactura.extraer_texto_solamente(file_content, file.filename)
+        with span("ocr_service_call"):
+            texto = await procesadorFactura.extraer_texto_solamente(file_content, file.filename)
         
         return {
             "filename": file.filename,
@@ -5,10 +5,59 @@ import cv2
 import numpy as np
 import io
 import re
-from typing import Dict
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+from admission import ControlAdmision, AdmisionRechazada, Cupo, leer_tamano
+from profiling import Perfilador, span, registrar_span
+from shm_pool import DescriptorImagen, PoolSlabs, procesar_imagen, workers_desde_entorno
+from dedup import IndiceDuplicados, calcular_huella
+from layout_templates import IndicePlantillas
 
 app = FastAPI(title="Tesseract OCR Service")
 
+# Perfilado bajo demanda (cabecera X-Profile, PROFILE_SAMPLE_RATE o /admin/profiling)
+Perfilador("ocr-service").instalar(app)
+
+# Control de admisión por megapíxeles en vuelo (ver admission.py); un timeout
+# o un worker caído cuentan como congestión para el AIMD
+control_admision = ControlAdmision.desde_entorno(congestion_errors=(TimeoutError, BrokenProcessPool))
+
+OCR_CONFIG = '--oem 3 --psm 6 -l spa+eng'
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+DECODE_STRIP_ROWS = 256
+
+# Procesos worker para OCR; la imagen decodificada viaja por memoria compartida
+OCR_WORKERS = workers_desde_entorno()
+pool_slabs = PoolSlabs(max_slabs=int(os.getenv("OCR_SHM_SLABS", str(control_admision.max_concurrency))))
+_executor = None
+
+# Índice de hashes perceptuales para reconocer comprobantes reenviados (ver dedup.py)
+indice_duplicados = None
+
+# Plantillas de layouts conocidos (ver layout_templates.json)
+indice_plantillas = None
+
+@app.on_event("startup")
+def load_indexes():
+    """Carga los índices solo en el proceso que atiende HTTP, no en los workers"""
+    global indice_duplicados, indice_plantillas
+    indice_duplicados = IndiceDuplicados.desde_entorno()
+    indice_plantillas = IndicePlantillas.desde_entorno()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    """Detiene los workers y borra los segmentos de memoria compartida"""
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+    pool_slabs.cerrar()
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -18,6 +67,221 @@ async def health_check():
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}
 
+@app.get("/admission")
+async def admission_stats():
+    """Estado del control de admisión (presupuesto, cola y límite AIMD)"""
+    return control_admision.estadisticas()
+
+@app.get("/shm")
+async def shm_stats():
+    """Estado del pool de memoria compartida y contadores de copias"""
+    return {"workers": OCR_WORKERS, **pool_slabs.estadisticas()}
+
+@app.get("/dedup")
+async def dedup_stats():
+    """Estado del índice de comprobantes casi duplicados"""
+    if indice_duplicados is None:
+        return {"enabled": False}
+    return {"enabled": True, **indice_duplicados.estadisticas()}
+
+@app.get("/templates")
+async def template_stats():
+    """Tasa de match de plantillas y tiempo ahorrado estimado"""
+    if indice_plantillas is None:
+        return {"enabled": False}
+    return {"enabled": True, **indice_plantillas.estadisticas()}
+
+def decode_into_slab(file_content: bytes, slab: shared_memory.SharedMemory) -> np.ndarray:
+    """Decodifica la imagen a escala de grises directamente en el slab
+
+    Es lo único que usa el OCR. Los pixeles se copian al slab por franjas, así
+    la única copia completa es la del slab; la imagen PIL se libera al salir.
+    """
+    with span("decode"):
+        with Image.open(io.BytesIO(file_content)) as image:
+            # En JPEG, draft hace que el decoder entregue escala de grises directamente
+            image.draft("L", image.size)
+            gray_image = image if image.mode == "L" else image.convert("L")
+            width, height = gray_image.size
+            gray = np.ndarray((height, width), dtype=np.uint8, buffer=slab.buf)
+            for y in range(0, height, DECODE_STRIP_ROWS):
+                with gray_image.crop((0, y, width, min(y + DECODE_STRIP_ROWS, height))) as strip:
+                    gray[y:y + strip.height] = np.asarray(strip)
+            gray_image.close()
+        return gray
+
+def ocr_array(gray: np.ndarray) -> Tuple[str, List]:
+    """Mejora la imagen y extrae el texto; devuelve también los tiempos por etapa
+
+    En un hilo del mismo proceso los span() quedan en el perfil (y en el
+    muestreo de stacks); en un worker no hay perfil activo y el proceso
+    principal registra los tiempos devueltos.
+    """
+    pid = os.getpid()
+    start = time.perf_counter()
+    with span("enhance_image"):
+        enhanced = enhance_array(gray)
+    enhanced_at = time.perf_counter()
+    with span("tesseract"):
+        text = pytesseract.image_to_string(enhanced, config=OCR_CONFIG, timeout=OCR_TIMEOUT)
+    timings = [
+        ("enhance_image", start, enhanced_at, pid),
+        ("tesseract", enhanced_at, time.perf_counter(), pid),
+    ]
+    return text, timings
+
+def ocr_worker(descriptor: DescriptorImagen) -> Tuple[str, List]:
+    """Punto de entrada en el proceso worker: lee la imagen del slab sin copiarla"""
+    return procesar_imagen(descriptor, ocr_array)
+
+def get_executor() -> ProcessPoolExecutor:
+    """Crea el pool de procesos la primera vez (o tras una caída de un worker)"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+async def run_in_worker(
+    slab: shared_memory.SharedMemory, descriptor: DescriptorImagen, cupo: Cupo
+) -> Tuple[str, List]:
+    """Pasa la imagen a un worker por memoria compartida y espera el resultado
+
+    Toma posesión del slab y del cupo de admisión: los devuelve cuando el
+    worker termina, aunque la solicitud haya expirado antes. Si la solicitud
+    expira mientras el trabajo sigue en la cola del executor, se cancela.
+    """
+    global _executor
+    liberar_cupo = cupo.retener()
+    try:
+        executor = get_executor()
+        job = executor.submit(ocr_worker, descriptor)
+    except BaseException:
+        pool_slabs.liberar(slab)
+        liberar_cupo()
+        raise
+    future = asyncio.wrap_future(job)
+
+    def on_done(f: asyncio.Future):
+        # El slab vuelve al pool recién cuando el worker terminó de leerlo (o
+        # el trabajo se canceló sin empezar), y los megapíxeles siguen
+        # cobrados mientras el worker los procesa
+        pool_slabs.liberar(slab)
+        liberar_cupo()
+        if not f.cancelled():
+            f.exception()
+
+    future.add_done_callback(on_done)
+
+    try:
+        # shield: si la solicitud expira o se cancela, un trabajo ya en curso
+        # sigue dueño del slab
+        return await asyncio.wait_for(asyncio.shield(future), timeout=OCR_TIMEOUT)
+    except asyncio.TimeoutError as e:
+        # cancel() solo tiene efecto si el trabajo todavía no pasó a un worker:
+        # así la cola no se llena de solicitudes que ya fallaron
+        job.cancel()
+        raise HTTPException(status_code=504, detail=f"OCR timeout after {OCR_TIMEOUT}s") from e
+    except asyncio.CancelledError:
+        job.cancel()
+        raise
+    except BrokenProcessPool:
+        # Un worker murió: descartar ese pool (y no uno nuevo creado por otra
+        # solicitud mientras tanto); el próximo pedido crea uno nuevo
+        if _executor is executor:
+            _executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+async def run_ocr_admitted(
+    file_content: bytes, use_templates: bool = False, use_dedup: bool = False
+) -> Tuple[str, Dict, Dict]:
+    """Ejecuta el OCR fuera del event loop, cobrando los megapíxeles de la imagen
+
+    Con use_dedup, primero busca un comprobante casi idéntico ya procesado;
+    con use_templates, intenta el camino rápido de plantillas. El tercer valor
+    devuelto indica el atajo usado ("duplicate" o "template", o None) y
+    la huella calculada, para guardarla en el índice después de parsear.
+    """
+    try:
+        width, height = leer_tamano(file_content)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+
+    plantillas = indice_plantillas if use_templates else None
+    duplicados = indice_duplicados if use_dedup else None
+    atajo = {"duplicate": None, "template": None, "huella": None}
+    timings = []
+    try:
+        async with control_admision.admitir(width * height / 1_000_000) as cupo:
+            # El slab se pide antes de decodificar: la imagen se decodifica una sola vez, ahí
+            slab = await pool_slabs.adquirir(width * height)
+            slab_propio = True
+            try:
+                gray = await asyncio.to_thread(decode_into_slab, file_content, slab)
+                pool_slabs.registrar_copia(gray.nbytes)
+                handoff = {"copies": 1, "bytes_copied": gray.nbytes, "shared_memory": False}
+
+                # Dedup y plantillas leen una vista del slab, sin copias adicionales;
+                # su costo queda cobrado dentro del presupuesto de admisión
+                if duplicados is not None:
+                    try:
+                        with span("dedup_lookup"):
+                            atajo["huella"] = await asyncio.to_thread(calcular_huella, gray)
+                            # Con muchos comprobantes del mismo layout la búsqueda no es
+                            # trivial: corre en un hilo para no frenar el event loop
+                            atajo["duplicate"] = await asyncio.to_thread(duplicados.buscar, atajo["huella"])
+                    except Exception as e:
+                        print(f"Error computing perceptual hash: {str(e)}")
+                    if atajo["duplicate"] is not None:
+                        return atajo["duplicate"]["extracted_text"], handoff, atajo
+
+                if plantillas is not None:
+                    # El tiempo de búsqueda cuenta siempre: si no hay match, es costo
+                    # agregado al pipeline completo
+                    start = time.perf_counter()
+                    try:
+                        plantilla = await asyncio.to_thread(plantillas.buscar, gray)
+                    except Exception as e:
+                        print(f"Error matching layout templates: {str(e)}")
+                        plantilla = None
+                    if plantilla is None:
+                        plantillas.registrar_sin_match(time.perf_counter() - start)
+                    else:
+                        try:
+                            resultado = await asyncio.to_thread(plantillas.extraer, gray, plantilla)
+                        except Exception as e:
+                            print(f"Error extracting template fields: {str(e)}")
+                            resultado = None
+                        if resultado is not None:
+                            plantillas.registrar_match(plantilla.id, time.perf_counter() - start)
+                            atajo["template"] = resultado
+                            return resultado["extracted_text"], handoff, atajo
+                        plantillas.registrar_fallback(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                if OCR_WORKERS > 0:
+                    descriptor = DescriptorImagen(slab.name, gray.shape, gray.dtype.str)
+                    del gray
+                    handoff["shared_memory"] = True
+                    slab_propio = False
+                    text, timings = await run_in_worker(slab, descriptor, cupo)
+                else:
+                    # Los span() de ocr_array ya quedaron en el perfil
+                    text, _ = await asyncio.to_thread(ocr_array, gray)
+                if plantillas is not None:
+                    plantillas.registrar_completo(time.perf_counter() - start)
+            finally:
+                if slab_propio:
+                    pool_slabs.liberar(slab)
+    except AdmisionRechazada as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+    for name, start, end, thread in timings:
+        registrar_span(name, start, end, thread)
+    return text, handoff, atajo
+
 @app.post("/extract-text")
 async def extract_text(file: UploadFile = File(...)):
     """Extrae texto de una imagen usando Tesseract OCR"""
@@ -26,23 +290,19 @@ async def extract_text(file: UploadFile = File(...)):
         # Leer contenido del archivo
         file_content = await file.read()
         
-        # Convertir a imagen PIL
-        image = Image.open(io.BytesIO(file_content))
-        
-        # Mejorar imagen
-        enhanced_image = enhance_image(image)
-        
-        # Extraer texto
-        config = '--oem 3 --psm 6 -l spa+eng'
-        text = pytesseract.image_to_string(enhanced_image, config=config)
+        # Decodificar, mejorar y extraer texto bajo el control de admisión
+        text, handoff, _ = await run_ocr_admitted(file_content)
         
         return {
             "success": True,
             "filename": file.filename,
             "extracted_text": text,
-            "text_length": len(text)
+            "text_length": len(text),
+            "handoff": handoff
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error extracting text: {str(e)}")
 
@@ -51,32 +311,61 @@ async def process_invoice(file: UploadFile = File(...)):
     """Procesa una factura completa y extrae datos estructurados"""
     
     try:
-        # Extraer texto primero
         file_content = await file.read()
-        image = Image.open(io.BytesIO(file_content))
-        enhanced_image = enhance_image(image)
-        
-        config = '--oem 3 --psm 6 -l spa+eng'
-        text = pytesseract.image_to_string(enhanced_image, config=config)
+
+        # Buscar un comprobante casi idéntico ya procesado (reenvío recomprimido) y, si
+        # no hay, extraer el texto (o solo los campos, si el layout es una plantilla conocida)
+        text, handoff, atajo = await run_ocr_admitted(file_content, use_templates=True, use_dedup=True)
+
+        duplicate = atajo["duplicate"]
+        if duplicate is not None:
+            return {
+                "success": True,
+                "filename": file.filename,
+                "extracted_text": duplicate.pop("extracted_text"),
+                "parsed_data": duplicate.pop("parsed_data"),
+                "handoff": handoff,
+                "template": None,
+                "duplicate": {"likely_duplicate": True, **duplicate}
+            }
         
         # Parsear datos
-        parsed_data = parse_invoice_data(text)
+        template = atajo["template"]
+        if template is not None:
+            parsed_data = template["parsed_data"]
+        else:
+            with span("parse_invoice_data"):
+                parsed_data = parse_invoice_data(text)
+
+        if atajo["huella"] is not None:
+            await asyncio.to_thread(
+                indice_duplicados.agregar, atajo["huella"], file.filename, text, parsed_data
+            )
         
         return {
             "success": True,
             "filename": file.filename,
             "extracted_text": text,
-            "parsed_data": parsed_data
+            "parsed_data": parsed_data,
+            "handoff": handoff,
+            "template": template["template"] if template else None,
+            "duplicate": None
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing invoice: {str(e)}")
 
 def enhance_image(image: Image.Image) -> Image.Image:
     """Mejora la imagen para mejor OCR"""
+    enhanced = enhance_array(np.array(image))
+    return Image.fromarray(enhanced)
+
+def enhance_array(img_array: np.ndarray) -> np.ndarray:
+    """Mejora un array de pixeles (RGB o escala de grises) para mejor OCR"""
     try:
         # Convertir PIL a OpenCV
-        img_array = np.array(image)
         if len(img_array.shape) == 3:
             img_cv = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
         else:
@@ -101,11 +390,11 @@ def enhance_image(image: Image.Image) -> Image.Image:
             cv2.THRESH_BINARY, 11, 2
         )
         
-        return Image.fromarray(binary)
+        return binary
         
     except Exception as e:
         print(f"Error enhancing image: {str(e)}")
-        return image
+        return img_array
 
 def parse_invoice_data(text: str) -> Dict:
     """Parsea el texto para extraer datos de factura"""
@@ -0,0 +1,327 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+# Perfil de la solicitud actual; asyncio.to_thread copia el contexto,
+# así los spans que corren en hilos de trabajo quedan en el mismo perfil
+_perfil_actual: contextvars.ContextVar[Optional["PerfilSolicitud"]] = contextvars.ContextVar(
+    "perfil_actual", default=None
+)
+
+
+class PerfilSolicitud:
+    """Timeline de spans y muestras de stack de una solicitud perfilada"""
+
+    def __init__(self, profile_id: str, service: str, path: str, interval: float):
+        self.id = profile_id
+        self.service = service
+        self.path = path
+        self.interval = interval
+        self.created_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.spans: List[Dict] = []
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+        # Hilo -> pila de spans activos en ese hilo
+        self._activos: Dict[int, List[str]] = {}
+        self._hilo_loop: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._muestrear, daemon=True)
+
+    def iniciar(self):
+        # Se llama desde el event loop: ese hilo es compartido por todas las
+        # solicitudes y pasa la mayor parte del tiempo en select() esperando
+        self._hilo_loop = threading.get_ident()
+        self._sampler.start()
+
+    def finalizar(self, status_code: int):
+        self._stop.set()
+        self._sampler.join()
+        self.status_code = status_code
+        self.duration_ms = round((time.perf_counter() - self.start) * 1000, 3)
+
+    def entrar(self, name: str) -> float:
+        with self._lock:
+            self._activos.setdefault(threading.get_ident(), []).append(name)
+        return time.perf_counter()
+
+    def salir(self, name: str, start: float):
+        end = time.perf_counter()
+        ident = threading.get_ident()
+        with self._lock:
+            pila = self._activos.get(ident, [])
+            if pila:
+                pila.pop()
+            if not pila:
+                self._activos.pop(ident, None)
+        self.agregar(name, start, end, ident)
+
+    def agregar(self, name: str, start: float, end: float, thread: int):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "thread": thread,
+                "start_ms": round((start - self.start) * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+            })
+
+    def _muestrear(self):
+        """ Muestrea los stacks de los hilos de trabajo que están dentro de un span
+
+        El hilo del event loop no se muestrea: sus spans abarcan awaits y la
+        muestra caería en select() o en otra solicitud. Esos spans quedan
+        solo en el timeline.
+        """
+        excluidos = {threading.get_ident(), self._hilo_loop}
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                activos = {ident: pila[-1] for ident, pila in self._activos.items() if pila}
+            if not activos:
+                continue
+            frames = sys._current_frames()
+            for ident, span in activos.items():
+                frame = frames.get(ident)
+                if frame is None or ident in excluidos:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(span)
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def folded(self) -> str:
+        """ Stacks en formato "collapsed" (flamegraph.pl, speedscope) """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def chrome_trace(self) -> Dict:
+        """ Timeline en formato Trace Event (chrome://tracing, Perfetto) """
+        return {
+            "traceEvents": [
+                {
+                    "name": span["name"],
+                    "ph": "X",
+                    "pid": self.service,
+                    "tid": span["thread"],
+                    "ts": span["start_ms"] * 1000,
+                    "dur": span["duration_ms"] * 1000,
+                }
+                for span in self.spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def resumen(self) -> Dict:
+        return {
+            "id": self.id,
+            "service": self.service,
+            "path": self.path,
+            "created_at": self.created_at,
+            "status_code": self.status_code,
+            "duration_ms": self.duration_ms,
+            "samples": self.samples,
+            "sample_interval_ms": self.interval * 1000,
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+        }
+
+
+@contextmanager
+def span(name: str):
+    """ Marca una etapa del pipeline; sin perfil activo no hace nada """
+    perfil = _perfil_actual.get()
+    if perfil is None:
+        yield
+        return
+    start = perfil.entrar(name)
+    try:
+        yield
+    finally:
+        perfil.salir(name, start)
+
+
+def registrar_span(name: str, start: float, end: float, thread: int):
+    """ Agrega un span medido en otro proceso (perf_counter es monotónico del sistema) """
+    perfil = _perfil_actual.get()
+    if perfil is not None:
+        perfil.agregar(name, start, end, thread)
+
+
+def cabeceras_propagacion() -> Dict[str, str]:
+    """ Cabeceras para perfilar también la llamada a otro servicio """
+    perfil = _perfil_actual.get()
+    if perfil is None:
+        return {}
+    headers = {PROFILE_HEADER: perfil.id}
+    if os.getenv("PROFILE_ADMIN_TOKEN"):
+        headers[ADMIN_TOKEN_HEADER] = os.environ["PROFILE_ADMIN_TOKEN"]
+    return headers
+
+
+class Perfilador:
+    """Perfilado bajo demanda de solicitudes de una app FastAPI
+
+    Una solicitud se perfila si sale sorteada por PROFILE_SAMPLE_RATE, si
+    trae la cabecera X-Profile o si quedan solicitudes pendientes pedidas
+    desde POST /admin/profiling. La cabecera y los endpoints de administración
+    solo existen si PROFILE_ADMIN_TOKEN está definido, y requieren X-Admin-Token.
+    """
+
+    def __init__(self, service: str):
+        self.service = service
+        self.sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+        self.interval = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+        self.max_profiles = int(os.getenv("PROFILE_MAX_STORED", "50"))
+        self.output_dir = os.getenv("PROFILE_DIR")
+        self.admin_token = os.getenv("PROFILE_ADMIN_TOKEN")
+        self.pending = 0
+        self.perfiles: "OrderedDict[str, PerfilSolicitud]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _autorizado(self, token: Optional[str]) -> bool:
+        return bool(self.admin_token) and token is not None and hmac.compare_digest(token, self.admin_token)
+
+    def _elegir(self, request: Request) -> Optional[str]:
+        """ Decide si perfilar la solicitud y devuelve el id del perfil """
+        pedido = request.headers.get(PROFILE_HEADER)
+        if pedido and self._autorizado(request.headers.get(ADMIN_TOKEN_HEADER)):
+            # Un id propagado desde el gateway se reutiliza para correlacionar
+            # (solo si es seguro usarlo como nombre de archivo y no pisa otro perfil)
+            if (len(pedido) <= 64 and pedido.isascii() and pedido.isalnum()
+                    and pedido not in ("1", "true") and pedido not in self.perfiles):
+                return pedido
+            return uuid.uuid4().hex
+        if self.pending > 0:
+            self.pending -= 1
+            return uuid.uuid4().hex
+        if self.sample_rate and random.random() < self.sample_rate:
+            return uuid.uuid4().hex
+        return None
+
+    def _cerrar(self, perfil: PerfilSolicitud, status_code: int):
+        """ Detiene el muestreo y guarda el perfil; bloquea, así que corre en un hilo """
+        perfil.finalizar(status_code)
+        with self._lock:
+            self.perfiles[perfil.id] = perfil
+            while len(self.perfiles) > self.max_profiles:
+                self.perfiles.popitem(last=False)
+
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            base = os.path.join(self.output_dir, f"{self.service}-{perfil.id}")
+            with open(f"{base}.folded", "w") as f:
+                f.write(perfil.folded())
+            with open(f"{base}.trace.json", "w") as f:
+                json.dump(perfil.chrome_trace(), f)
+
+    def _obtener(self, profile_id: str, token: Optional[str]) -> PerfilSolicitud:
+        if not self._autorizado(token):
+            raise HTTPException(status_code=403, detail="Admin token inválido")
+        with self._lock:
+            perfil = self.perfiles.get(profile_id)
+        if perfil is None:
+            raise HTTPException(status_code=404, detail="Perfil no encontrado")
+        return perfil
+
+    def instalar(self, app: FastAPI):
+        """ Registra el middleware y los endpoints /admin/profiling en la app """
+
+        @app.middleware("http")
+        async def profiling_middleware(request: Request, call_next):
+            profile_id = self._elegir(request) if not request.url.path.startswith("/admin/") else None
+            if profile_id is None:
+                return await call_next(request)
+
+            perfil = PerfilSolicitud(profile_id, self.service, request.url.path, self.interval)
+            token = _perfil_actual.set(perfil)
+            perfil.iniciar()
+            status_code = 500
+            try:
+                with span(f"{self.service} {request.method} {request.url.path}"):
+                    response = await call_next(request)
+                status_code = response.status_code
+                response.headers[PROFILE_ID_HEADER] = profile_id
+                return response
+            finally:
+                _perfil_actual.reset(token)
+                await asyncio.to_thread(self._cerrar, perfil, status_code)
+
+        # Sin token no hay forma segura de pedir ni leer perfiles: solo queda el muestreo
+        if not self.admin_token:
+            return
+
+        router = APIRouter(prefix="/admin/profiling", tags=["profiling"])
+
+        @router.get("")
+        async def profiling_status(x_admin_token: Optional[str] = Header(None)):
+            """Configuración actual y perfiles almacenados"""
+            if not self._autorizado(x_admin_token):
+                raise HTTPException(status_code=403, detail="Admin token inválido")
+            with self._lock:
+                perfiles = list(self.perfiles.values())
+            return {
+                "service": self.service,
+                "sample_rate": self.sample_rate,
+                "pending_requests": self.pending,
+                "interval_ms": self.interval * 1000,
+                "profiles": [
+                    {"id": p.id, "path": p.path, "duration_ms": p.duration_ms, "created_at": p.created_at}
+                    for p in reversed(perfiles)
+                ],
+            }
+
+        @router.post("")
+        async def configure_profiling(
+            sample_rate: Optional[float] = None,
+            next_requests: Optional[int] = None,
+            x_admin_token: Optional[str] = Header(None),
+        ):
+            """Ajusta la tasa de muestreo o perfila las próximas N solicitudes"""
+            if not self._autorizado(x_admin_token):
+                raise HTTPException(status_code=403, detail="Admin token inválido")
+            if sample_rate is not None:
+                if not 0 <= sample_rate <= 1:
+                    raise HTTPException(status_code=400, detail="sample_rate debe estar entre 0 y 1")
+                self.sample_rate = sample_rate
+            if next_requests is not None:
+                self.pending = max(next_requests, 0)
+            return {"sample_rate": self.sample_rate, "pending_requests": self.pending}
+
+        @router.get("/{profile_id}")
+        async def profile_summary(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+            """Resumen y timeline de spans de un perfil"""
+            return self._obtener(profile_id, x_admin_token).resumen()
+
+        @router.get("/{profile_id}/flamegraph", response_class=PlainTextResponse)
+        async def profile_flamegraph(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+            """Stacks muestreados en formato collapsed para flamegraph.pl/speedscope"""
+            return self._obtener(profile_id, x_admin_token).folded()
+
+        @router.get("/{profile_id}/trace")
+        async def profile_trace(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+            """Timeline de spans en formato Chrome Trace Event"""
+            return self._obtener(profile_id, x_admin_token).chrome_trace()
+
+        app.include_router(router)
@@ -31,6 +31,11 @@ case "$1" in
         echo "🧪 Probando imagen local..."
         uv run python main_ocr.py
         ;;
+    "loadtest")
+        echo "📈 Prueba de carga gateway + servicio OCR..."
+        shift
+        uv run python loadtest.py "$@"
+        ;;
     "logs")
         echo "📋 Mostrando logs..."
         docker-compose logs -f
@@ -52,6 +57,7 @@ case "$1" in
         echo "  ./run.sh ocr-only    - Solo servicio OCR"
         echo "  ./run.sh dev         - Modo desarrollo"
         echo "  ./run.sh test        - Probar imagen local"
+        echo "  ./run.sh loadtest    - Prueba de carga (reporte JSON)"
         echo "  ./run.sh logs        - Ver logs"
         echo "  ./run.sh stop        - Detener servicios"
         echo "  ./run.sh clean       - Limpiar todo"
@@ -3,6 +3,8 @@ import httpx
 from typing import Dict, Optional
 from datetime import datetime
 
+from profiling import cabeceras_propagacion
+
 
 class ProcesadorFacturaOCR:
     """Cliente para el servicio OCR en Docker"""
@@ -25,7 +27,8 @@ class ProcesadorFacturaOCR:
                 # Llamar al servicio OCR
                 response = await client.post(
                     f"{self.ocr_service_url}/process-invoice", 
-                    files=files
+                    files=files,
+                    headers=cabeceras_propagacion()
                 )
                 
                 if response.status_code != 200:
@@ -55,7 +58,8 @@ class ProcesadorFacturaOCR:
             async with httpx.AsyncClient(timeout=30.0) as client:
                 response = await client.post(
                     f"{self.ocr_service_url}/extract-text", 
-                    files=files
+                    files=files,
+                    headers=cabeceras_propagacion()
                 )
                 
                 if response.status_code != 200:
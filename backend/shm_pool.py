@@ -0,0 +1,136 @@
+import asyncio
+import os
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, NamedTuple, Tuple, TypeVar
+
+import numpy as np
+
+MIN_SLAB_BYTES = 1 << 20
+
+T = TypeVar("T")
+
+
+class DescriptorImagen(NamedTuple):
+    """Lo único que viaja al proceso worker: dónde está la imagen y cómo leerla"""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+def _tamano_slab(nbytes: int) -> int:
+    """ Redondea a potencia de 2 para que los slabs se puedan reutilizar """
+    size = MIN_SLAB_BYTES
+    while size < nbytes:
+        size <<= 1
+    return size
+
+
+class PoolSlabs:
+    """Pool acotado de segmentos de memoria compartida para pasar imágenes
+
+    El proceso principal es dueño de todos los slabs: los crea, decodifica
+    las imágenes directamente en ellos, los recicla y los borra (unlink).
+    Los workers solo se adjuntan por nombre y cierran.
+    Un slab no vuelve al pool hasta que el worker que lo usa terminó, aunque
+    la solicitud haya expirado antes.
+    """
+
+    def __init__(self, max_slabs: int = 8):
+        """ Inicializa el pool con un máximo de slabs vivos """
+        self.max_slabs = max_slabs
+        self._libres: List[shared_memory.SharedMemory] = []
+        self._en_uso: Dict[str, shared_memory.SharedMemory] = {}
+        self._disponible = asyncio.Semaphore(max_slabs)
+
+        self.created = 0
+        self.reused = 0
+        self.destroyed = 0
+        self.copies = 0
+        self.bytes_copied = 0
+
+    async def adquirir(self, nbytes: int) -> shared_memory.SharedMemory:
+        """ Obtiene un slab de al menos nbytes, esperando si el pool está lleno """
+        await self._disponible.acquire()
+        try:
+            candidatos = [s for s in self._libres if s.size >= nbytes]
+            if candidatos:
+                slab = min(candidatos, key=lambda s: s.size)
+                self._libres.remove(slab)
+                self.reused += 1
+            else:
+                # Ningún slab libre alcanza: descartar el más chico para no pasar el máximo
+                if self._libres and len(self._libres) + len(self._en_uso) >= self.max_slabs:
+                    self._destruir(min(self._libres, key=lambda s: s.size))
+                slab = shared_memory.SharedMemory(create=True, size=_tamano_slab(nbytes))
+                self.created += 1
+        except BaseException:
+            self._disponible.release()
+            raise
+
+        self._en_uso[slab.name] = slab
+        return slab
+
+    def liberar(self, slab: shared_memory.SharedMemory):
+        """ Devuelve el slab al pool para reutilizarlo """
+        if self._en_uso.pop(slab.name, None) is None:
+            return
+        self._libres.append(slab)
+        self._disponible.release()
+
+    def registrar_copia(self, nbytes: int):
+        """ Cuenta una copia de pixeles hecha en el camino de la solicitud """
+        self.copies += 1
+        self.bytes_copied += nbytes
+
+    def _destruir(self, slab: shared_memory.SharedMemory):
+        self._libres.remove(slab)
+        slab.close()
+        slab.unlink()
+        self.destroyed += 1
+
+    def cerrar(self):
+        """ Borra todos los slabs; llamar al apagar el servicio """
+        for slab in list(self._libres) + list(self._en_uso.values()):
+            try:
+                slab.close()
+                slab.unlink()
+            except (BufferError, FileNotFoundError):
+                pass
+        self._libres.clear()
+        self._en_uso.clear()
+
+    def estadisticas(self) -> Dict:
+        """ Devuelve el estado del pool y los contadores de copias """
+        return {
+            "max_slabs": self.max_slabs,
+            "free": len(self._libres),
+            "in_use": len(self._en_uso),
+            "pool_bytes": sum(s.size for s in self._libres + list(self._en_uso.values())),
+            "created": self.created,
+            "reused": self.reused,
+            "destroyed": self.destroyed,
+            "copies": self.copies,
+            "bytes_copied": self.bytes_copied,
+        }
+
+
+def procesar_imagen(descriptor: DescriptorImagen, fn: Callable[[np.ndarray], T]) -> T:
+    """ Lado worker: llama a fn con una vista de NumPy sobre el slab, sin copiar
+
+    La vista solo existe durante la llamada; fn no debe devolverla ni guardarla,
+    porque el slab no se puede cerrar mientras haya referencias a su buffer.
+    """
+    try:
+        # track=False (3.13+): el worker no es dueño del segmento
+        slab = shared_memory.SharedMemory(name=descriptor.name, track=False)
+    except TypeError:
+        slab = shared_memory.SharedMemory(name=descriptor.name)
+    try:
+        return fn(np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=slab.buf))
+    finally:
+        slab.close()
+
+
+def workers_desde_entorno() -> int:
+    """ Cantidad de procesos worker para OCR (0 = hilos en el mismo proceso) """
+    return int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from admission import AdmisionRechazada, ControlAdmision
+
+
+def test_costo_acotado_al_presupuesto():
+    control = ControlAdmision(budget_mp=10)
+    assert control.costo(0.01) == control.min_cost_mp
+    assert control.costo(3) == 3
+    assert control.costo(48) == 10
+
+
+def test_fifo_estricta_no_adelanta_a_la_imagen_grande():
+    async def escenario():
+        control = ControlAdmision(budget_mp=10, max_concurrency=8)
+        orden = []
+
+        async def solicitud(nombre, megapixeles, espera):
+            async with control.admitir(megapixeles):
+                orden.append(nombre)
+                await asyncio.sleep(espera)
+
+        primera = asyncio.create_task(solicitud("chica_1", 6, 0.05))
+        await asyncio.sleep(0)
+        grande = asyncio.create_task(solicitud("grande", 8, 0))
+        await asyncio.sleep(0)
+        # Entraría en el presupuesto libre, pero la grande está antes en la cola
+        chica = asyncio.create_task(solicitud("chica_2", 2, 0))
+        await asyncio.gather(primera, grande, chica)
+        return orden, control
+
+    orden, control = asyncio.run(escenario())
+    assert orden == ["chica_1", "grande", "chica_2"]
+    assert control.in_flight == 0
+    assert control.in_flight_mp == 0
+
+
+def test_imagen_mayor_al_presupuesto_corre_sola():
+    async def escenario():
+        control = ControlAdmision(budget_mp=10)
+        async with control.admitir(50):
+            assert control.in_flight_mp == 10
+        return control
+
+    assert asyncio.run(escenario()).in_flight == 0
+
+
+def test_rechaza_si_no_hay_presupuesto_a_tiempo():
+    async def escenario():
+        control = ControlAdmision(budget_mp=4, queue_timeout=0.05)
+        async with control.admitir(4):
+            with pytest.raises(AdmisionRechazada):
+                async with control.admitir(1):
+                    pass
+        return control
+
+    control = asyncio.run(escenario())
+    assert control.rejected == 1
+    assert control.in_flight == 0
+    assert not control._waiters
+
+
+def test_aimd_incremento_aditivo_hasta_el_maximo():
+    control = ControlAdmision(max_concurrency=8)
+    control.limit = 2.0
+    for _ in range(4):
+        control.ajustar(0.1, 1.0, control._epoch)
+    assert 3.0 < control.limit < 4.0
+    for _ in range(100):
+        control.ajustar(0.1, 1.0, control._epoch)
+    assert control.limit == 8.0
+
+
+def test_objetivo_incluye_costo_fijo():
+    control = ControlAdmision(target_base_ms=1500, target_ms_per_mp=400)
+    # Una imagen chica que tarda lo que tarda arrancar Tesseract no es congestión
+    control.ajustar(1.2, 0.3, control._epoch)
+    assert control.decreases == 0
+    control.ajustar(3.0, 1.0, control._epoch)
+    assert control.decreases == 1
+
+
+def test_aimd_un_solo_decremento_por_ventana():
+    control = ControlAdmision(max_concurrency=8)
+    epoch = control._epoch
+    # Cinco solicitudes lentas admitidas en la misma ventana
+    for _ in range(5):
+        control.ajustar(60.0, 1.0, epoch)
+    assert control.limit == 4.0
+    assert control.decreases == 1
+
+    # Una solicitud admitida después del decremento sí puede volver a reducir
+    control.ajustar(60.0, 1.0, control._epoch)
+    assert control.limit == 2.0
+    assert control.decreases == 2
+
+
+def test_timeout_cuenta_como_congestion():
+    async def escenario():
+        control = ControlAdmision(max_concurrency=8)
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                async with control.admitir(1):
+                    try:
+                        raise asyncio.TimeoutError()
+                    except asyncio.TimeoutError as e:
+                        # Como el 504 de run_in_worker: el timeout queda como causa
+                        raise RuntimeError("OCR timeout") from e
+        return control
+
+    control = asyncio.run(escenario())
+    assert control.decreases == 3
+    assert control.limit == 1.0
+    assert control.in_flight == 0
+
+
+def test_errores_que_no_son_de_carga_no_reducen():
+    async def escenario():
+        control = ControlAdmision(max_concurrency=8)
+        with pytest.raises(ValueError):
+            async with control.admitir(1):
+                raise ValueError("imagen inválida")
+        return control
+
+    control = asyncio.run(escenario())
+    assert control.decreases == 0
+    assert control.limit == 8.0
+    assert control.in_flight == 0
+
+
+def test_cupo_retenido_sigue_cobrado_hasta_liberarlo():
+    async def escenario():
+        control = ControlAdmision(budget_mp=10, max_concurrency=8)
+        with pytest.raises(RuntimeError):
+            async with control.admitir(3) as cupo:
+                liberar = cupo.retener()
+                raise RuntimeError("la solicitud expiró, el worker sigue")
+        retenido = (control.in_flight, control.in_flight_mp)
+        liberar()
+        liberar()
+        return retenido, control
+
+    retenido, control = asyncio.run(escenario())
+    assert retenido == (1, 3)
+    assert control.in_flight == 0
+    assert control.in_flight_mp == 0
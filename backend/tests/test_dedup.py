@@ -0,0 +1,147 @@
+import io
+import random
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from dedup import IndiceDuplicados, IndiceMultiHash, calcular_huella
+
+SAMPLE = Path(__file__).resolve().parent.parent / "images" / "mercado_pago.jpeg"
+
+
+def _codificar(image: Image.Image, quality=85) -> np.ndarray:
+    """ Guarda y vuelve a decodificar a escala de grises, como lo hace el servicio """
+    buffer = io.BytesIO()
+    if quality is None:
+        image.save(buffer, "PNG")
+    else:
+        image.save(buffer, "JPEG", quality=quality)
+    with Image.open(io.BytesIO(buffer.getvalue())) as decoded:
+        return np.asarray(decoded.convert("L"))
+
+
+def _original() -> Image.Image:
+    return Image.open(SAMPLE).convert("RGB")
+
+
+def _variante(scale: float, quality) -> np.ndarray:
+    """ Reenvío típico: el comprobante redimensionado y recomprimido """
+    image = _original()
+    image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    return _codificar(image, quality)
+
+
+def _editado(amount=None, operation=None, date=None) -> np.ndarray:
+    """ Otro comprobante del mismo layout: mismo pagador y destinatario, otros datos """
+    image = _original()
+    draw = ImageDraw.Draw(image)
+    if amount:
+        draw.rectangle((30, 285, 300, 335), fill="white")
+        draw.text((33, 286), amount, fill=(20, 20, 20), font=ImageFont.load_default(size=40))
+    if operation:
+        draw.rectangle((30, 865, 300, 895), fill="white")
+        draw.text((33, 867), operation, fill=(20, 20, 20), font=ImageFont.load_default(size=20))
+    if date:
+        draw.rectangle((30, 183, 440, 210), fill="white")
+        draw.text((33, 185), date, fill=(40, 40, 40), font=ImageFont.load_default(size=18))
+    return _codificar(image)
+
+
+@pytest.fixture
+def indice(tmp_path):
+    indice = IndiceDuplicados(str(tmp_path / "dedup.sqlite3"))
+    huella = calcular_huella(np.asarray(_original().convert("L")))
+    indice.agregar(huella, "mercado_pago.jpeg", "texto original", {"total": 400.0})
+    return indice
+
+
+@pytest.mark.parametrize("scale", [0.5, 0.6, 0.8, 0.9, 1.6])
+@pytest.mark.parametrize("quality", [30, 40, 60, 75, 90, None])
+def test_encuentra_copia_redimensionada_y_recomprimida(indice, scale, quality):
+    duplicate = indice.buscar(calcular_huella(_variante(scale, quality)))
+    assert duplicate is not None
+    assert duplicate["extracted_text"] == "texto original"
+    assert duplicate["parsed_data"] == {"total": 400.0}
+
+
+@pytest.mark.parametrize("cambios", [
+    {"amount": "$ 900"},
+    {"amount": "$ 401"},
+    {"amount": "$ 750", "operation": "122790619999", "date": "Lunes, 22 de septiembre de 2025 a las 10:03 hs"},
+    {"amount": "$ 520", "operation": "122790688888"},
+    {"operation": "122790613306"},
+])
+def test_no_confunde_otro_comprobante_del_mismo_layout(indice, cambios):
+    assert indice.buscar(calcular_huella(_editado(**cambios))) is None
+    assert indice.rejected_by_content >= 1
+
+
+@pytest.mark.parametrize("fill", [0, 255])
+def test_no_confunde_imagen_en_blanco(indice, fill):
+    blank = np.full((950, 631), fill, dtype=np.uint8)
+    assert indice.buscar(calcular_huella(blank)) is None
+
+
+def test_encuentra_el_original_entre_muchos_del_mismo_layout(tmp_path):
+    indice = IndiceDuplicados(str(tmp_path / "dedup.sqlite3"))
+    for n in range(30):
+        huella = calcular_huella(_editado(amount=f"$ {100 + n * 37}", operation=f"1227906{n:05d}"))
+        indice.agregar(huella, f"otro_{n}.jpeg", "otro", {"total": 100.0 + n * 37})
+    indice.agregar(calcular_huella(np.asarray(_original().convert("L"))), "original.jpeg", "texto", {"total": 400.0})
+
+    duplicate = indice.buscar(calcular_huella(_variante(0.6, 40)))
+    assert duplicate is not None
+    assert duplicate["filename"] == "original.jpeg"
+
+
+def test_indice_persistente(tmp_path, indice):
+    reabierto = IndiceDuplicados(str(tmp_path / "dedup.sqlite3"))
+    assert reabierto.buscar(calcular_huella(_variante(0.8, 60)))["match_id"] == 1
+
+
+def test_base_anterior_sin_firma_no_confirma_duplicados(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    huella = calcular_huella(np.asarray(_original().convert("L")))
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE receipts (id INTEGER PRIMARY KEY AUTOINCREMENT, phash TEXT NOT NULL, "
+        "dhash TEXT NOT NULL, filename TEXT, extracted_text TEXT, parsed_data TEXT, created_at TEXT NOT NULL)"
+    )
+    db.execute(
+        "INSERT INTO receipts (phash, dhash, filename, extracted_text, parsed_data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (f"{huella.phash:016x}", f"{huella.dhash:064x}", "viejo.jpeg", "texto", "{}", "2025-01-01"),
+    )
+    db.commit()
+    db.close()
+
+    indice = IndiceDuplicados(path)
+    assert len(indice._indice) == 1
+    assert indice.buscar(huella) is None
+
+
+def test_multihash_coincide_con_fuerza_bruta():
+    rng = random.Random(0)
+    indice = IndiceMultiHash()
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    # Vecinos cercanos y repetidos a propósito, como los de un mismo layout
+    for posicion in range(0, 2000, 50):
+        valor = hashes[posicion]
+        for bit in rng.sample(range(64), 6):
+            valor ^= 1 << bit
+        hashes.extend([valor, hashes[posicion]])
+    for valor in hashes:
+        indice.agregar(valor)
+    assert indice.valores_distintos() == len(set(hashes))
+
+    for consulta in hashes[::40]:
+        for radio in (0, 4, 8):
+            esperado = sorted(
+                (i for i, h in enumerate(hashes) if (consulta ^ h).bit_count() <= radio)
+            )
+            obtenido = indice.buscar(consulta, radio)
+            assert sorted(p for _, posiciones in obtenido for p in posiciones) == esperado
+            for distancia, posiciones in obtenido:
+                assert all((consulta ^ hashes[p]).bit_count() == distancia for p in posiciones)
@@ -0,0 +1,104 @@
+import asyncio
+import io
+from pathlib import Path
+
+import numpy as np
+import pytest
+import pytesseract
+from PIL import Image, ImageDraw, ImageFont
+
+from layout_templates import IndicePlantillas, Plantilla
+
+BACKEND = Path(__file__).resolve().parent.parent
+SAMPLE = BACKEND / "images" / "mercado_pago.jpeg"
+
+
+@pytest.fixture(scope="module")
+def indice():
+    return IndicePlantillas.desde_archivo(str(BACKEND / "layout_templates.json"))
+
+
+def _variante(scale: float, quality) -> np.ndarray:
+    """ El comprobante redimensionado y recomprimido, ya en escala de grises """
+    image = Image.open(SAMPLE).convert("RGB")
+    image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    buffer = io.BytesIO()
+    if quality is None:
+        image.save(buffer, "PNG")
+    else:
+        image.save(buffer, "JPEG", quality=quality)
+    return np.asarray(Image.open(buffer).convert("L"))
+
+
+@pytest.mark.parametrize("scale", [0.5, 0.8, 1.0, 1.6])
+@pytest.mark.parametrize("quality", [40, 75, None])
+def test_reconoce_comprobante_mercado_pago(indice, scale, quality):
+    plantilla = indice.buscar(_variante(scale, quality))
+    assert plantilla is not None
+    assert plantilla.id == "mercado_pago_transferencia"
+
+
+@pytest.mark.parametrize("fill", [0, 255])
+def test_no_coincide_con_imagen_en_blanco(indice, fill):
+    assert indice.buscar(np.full((950, 631), fill, dtype=np.uint8)) is None
+
+
+def test_no_coincide_con_documento_a4(indice):
+    # A4 (1.41) entra en el rango de aspecto: lo descarta el ancla
+    image = Image.new("L", (1240, 1754), 255)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=28)
+    for y in range(100, 1700, 45):
+        draw.text((100, y), "FACTURA B  Nro 0001-00001234  Total $ 12.345,67", fill=0, font=font)
+    assert indice.buscar(np.asarray(image)) is None
+
+
+def test_no_coincide_con_otro_emisor(indice):
+    image = Image.new("L", (631, 950), 255)
+    draw = ImageDraw.Draw(image)
+    draw.text((30, 55), "Banco Nacion", fill=0, font=ImageFont.load_default(size=44))
+    draw.text((30, 150), "Comprobante de transferencia", fill=0, font=ImageFont.load_default(size=28))
+    assert indice.buscar(np.asarray(image)) is None
+
+
+@pytest.mark.parametrize("size", [(2, 3), (10, 15), (40, 60)])
+def test_imagen_diminuta_no_rompe_la_busqueda(indice, size):
+    width, height = size
+    assert indice.buscar(np.full((height, width), 255, dtype=np.uint8)) is None
+
+
+def test_falla_de_tesseract_en_palabras_clave_no_rompe_la_busqueda(monkeypatch, tmp_path):
+    def falla(*args, **kwargs):
+        raise RuntimeError("tesseract no disponible")
+
+    monkeypatch.setattr(pytesseract, "image_to_string", falla)
+    plantilla = Plantilla({
+        "id": "banco_textual",
+        "keywords": {"region": [0.0, 0.0, 1.0, 0.2], "any": ["banco"]},
+        "fields": [{"name": "total", "region": [0.0, 0.3, 1.0, 0.1]}],
+    }, str(tmp_path))
+    indice = IndicePlantillas([plantilla])
+    assert indice.buscar(np.full((950, 631), 255, dtype=np.uint8)) is None
+
+
+def test_servicio_usa_el_pipeline_completo_si_la_busqueda_falla(monkeypatch):
+    import ocr_service
+
+    class PlantillasRotas(IndicePlantillas):
+        def buscar(self, gray):
+            raise ValueError("recorte inválido")
+
+    plantillas = PlantillasRotas([])
+    monkeypatch.setattr(ocr_service, "indice_plantillas", plantillas)
+    monkeypatch.setattr(ocr_service, "OCR_WORKERS", 0)
+    monkeypatch.setattr(ocr_service, "ocr_array", lambda gray: ("texto completo", []))
+
+    image = Image.new("L", (2, 3), 255)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    text, _, atajo = asyncio.run(ocr_service.run_ocr_admitted(buffer.getvalue(), use_templates=True))
+
+    assert text == "texto completo"
+    assert atajo["template"] is None
+    assert plantillas.misses == 1
+    assert plantillas.saved_seconds < 0
@@ -0,0 +1,25 @@
+import httpx
+import pytest
+
+from loadtest import clasificar_error
+
+
+def _gateway(detalle: str) -> httpx.Response:
+    """ Respuesta del gateway: toda falla del servicio OCR llega como 500 """
+    return httpx.Response(500, json={"detail": f"Error al procesar archivo: Error al procesar factura a.jpg: {detalle}"})
+
+
+@pytest.mark.parametrize("detalle, esperado", [
+    ('Error en servicio OCR: 503 - {"detail":"Sin presupuesto de OCR disponible tras 30.0s"}', "ocr_503"),
+    ('Error en servicio OCR: 504 - {"detail":"OCR timeout after 60.0s"}', "ocr_504"),
+    ('Error en servicio OCR: 400 - {"detail":"Invalid image: cannot identify image file"}', "ocr_400"),
+    ("Timeout al procesar la imagen. El archivo puede ser muy grande.", "gateway_timeout"),
+    ("No se puede conectar al servicio OCR. Asegúrate de que el servicio esté ejecutándose.", "ocr_unreachable"),
+])
+def test_clasifica_por_el_detalle_del_gateway(detalle, esperado):
+    assert clasificar_error(_gateway(detalle)) == esperado
+
+
+def test_sin_detalle_reconocible_usa_el_codigo_http():
+    assert clasificar_error(httpx.Response(502, text="Bad Gateway")) == "http_502"
+    assert clasificar_error(httpx.Response(400, json={"detail": "Archivo requerido"})) == "http_400"
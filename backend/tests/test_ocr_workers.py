@@ -0,0 +1,70 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+import ocr_service
+from admission import ControlAdmision
+from shm_pool import DescriptorImagen, PoolSlabs
+
+
+def ocr_lento(descriptor: DescriptorImagen):
+    """ Reemplazo de ocr_worker: anota cada ejecución y tarda más que el timeout """
+    with open(os.environ["TEST_WORKER_LOG"], "a") as f:
+        f.write(f"{descriptor.name}\n")
+    time.sleep(0.5)
+    return "ok", []
+
+
+@pytest.fixture
+def servicio(monkeypatch, tmp_path):
+    log = tmp_path / "ejecuciones.log"
+    log.touch()
+    monkeypatch.setenv("TEST_WORKER_LOG", str(log))
+    monkeypatch.setattr(ocr_service, "ocr_worker", ocr_lento)
+    monkeypatch.setattr(ocr_service, "OCR_WORKERS", 1)
+    monkeypatch.setattr(ocr_service, "OCR_TIMEOUT", 0.2)
+    monkeypatch.setattr(ocr_service, "_executor", None)
+    monkeypatch.setattr(ocr_service, "pool_slabs", PoolSlabs(max_slabs=8))
+    monkeypatch.setattr(ocr_service, "control_admision", ControlAdmision(max_concurrency=8))
+    yield log
+    if ocr_service._executor is not None:
+        ocr_service._executor.shutdown(wait=True)
+    ocr_service.pool_slabs.cerrar()
+
+
+def test_timeout_cancela_trabajos_encolados(servicio):
+    control = ocr_service.control_admision
+    pool = ocr_service.pool_slabs
+
+    async def solicitud():
+        async with control.admitir(1) as cupo:
+            slab = await pool.adquirir(1 << 20)
+            gray = np.ndarray((1024, 1024), dtype=np.uint8, buffer=slab.buf)
+            descriptor = DescriptorImagen(slab.name, gray.shape, gray.dtype.str)
+            del gray
+            await ocr_service.run_in_worker(slab, descriptor, cupo)
+
+    async def escenario():
+        # Arrancar el worker antes, para que el timeout no incluya el spawn
+        await asyncio.wrap_future(ocr_service.get_executor().submit(time.sleep, 0))
+        resultados = await asyncio.gather(*(solicitud() for _ in range(6)), return_exceptions=True)
+        await asyncio.sleep(0.05)
+        tras_timeout = (pool.estadisticas()["in_use"], control.in_flight)
+        while pool.estadisticas()["in_use"]:
+            await asyncio.sleep(0.05)
+        return resultados, tras_timeout
+
+    resultados, (slabs_en_uso, en_vuelo) = asyncio.run(escenario())
+
+    assert all(isinstance(r, HTTPException) and r.status_code == 504 for r in resultados)
+    # Solo siguen los trabajos que ya pasaron al worker (el que corre y el
+    # que el executor adelanta a su cola interna); el resto se canceló
+    ejecutados = len(servicio.read_text().splitlines())
+    assert ejecutados <= 2
+    assert slabs_en_uso == en_vuelo == ejecutados
+    assert control.in_flight == 0
+    assert control.decreases >= 1
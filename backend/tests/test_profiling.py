@@ -0,0 +1,64 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from profiling import PerfilSolicitud, Perfilador, _perfil_actual, span
+
+
+def _trabajo_cpu(segundos: float):
+    limite = time.perf_counter() + segundos
+    while time.perf_counter() < limite:
+        sum(range(1000))
+
+
+def test_no_muestrea_el_hilo_del_event_loop():
+    async def escenario():
+        perfil = PerfilSolicitud("abc", "test", "/", interval=0.002)
+        token = _perfil_actual.set(perfil)
+        perfil.iniciar()
+        try:
+            with span("solicitud"):
+                # El loop queda esperando en select() mientras el hilo trabaja
+                with span("espera_en_loop"):
+                    await asyncio.sleep(0.05)
+                await asyncio.to_thread(_en_hilo)
+        finally:
+            _perfil_actual.reset(token)
+            perfil.finalizar(200)
+        return perfil
+
+    def _en_hilo():
+        with span("trabajo"):
+            _trabajo_cpu(0.1)
+
+    perfil = asyncio.run(escenario())
+    assert perfil.samples > 0
+    assert all(stack.startswith("trabajo;") for stack in perfil.stacks)
+    assert any("_trabajo_cpu" in stack for stack in perfil.stacks)
+    # Los spans del loop siguen en el timeline
+    assert {"solicitud", "espera_en_loop", "trabajo"} <= {s["name"] for s in perfil.spans}
+
+
+def _request(headers):
+    return SimpleNamespace(headers=headers)
+
+
+def test_cabecera_ignorada_sin_token_configurado(monkeypatch):
+    monkeypatch.delenv("PROFILE_ADMIN_TOKEN", raising=False)
+    monkeypatch.delenv("PROFILE_SAMPLE_RATE", raising=False)
+    perfilador = Perfilador("test")
+    assert perfilador._elegir(_request({"X-Profile": "1", "X-Admin-Token": ""})) is None
+
+
+def test_cabecera_requiere_token_valido_y_no_pisa_perfiles(monkeypatch):
+    monkeypatch.setenv("PROFILE_ADMIN_TOKEN", "secreto")
+    monkeypatch.delenv("PROFILE_SAMPLE_RATE", raising=False)
+    perfilador = Perfilador("test")
+    assert perfilador._elegir(_request({"X-Profile": "abc123", "X-Admin-Token": "otro"})) is None
+    assert perfilador._elegir(_request({"X-Profile": "abc123", "X-Admin-Token": "secreto"})) == "abc123"
+
+    perfilador.perfiles["abc123"] = object()
+    nuevo = perfilador._elegir(_request({"X-Profile": "abc123", "X-Admin-Token": "secreto"}))
+    assert nuevo not in (None, "abc123")
+    # Un id que no sirve como nombre de archivo se reemplaza
+    assert perfilador._elegir(_request({"X-Profile": "../x", "X-Admin-Token": "secreto"})) != "../x"
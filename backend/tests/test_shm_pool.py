@@ -0,0 +1,94 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from shm_pool import MIN_SLAB_BYTES, DescriptorImagen, PoolSlabs, _tamano_slab, procesar_imagen
+
+
+@pytest.fixture
+def pool():
+    pool = PoolSlabs(max_slabs=2)
+    yield pool
+    pool.cerrar()
+
+
+def test_tamano_potencia_de_dos_con_minimo():
+    assert _tamano_slab(1) == MIN_SLAB_BYTES
+    assert _tamano_slab(MIN_SLAB_BYTES + 1) == 2 * MIN_SLAB_BYTES
+    assert _tamano_slab(3_000_000) == 4 * MIN_SLAB_BYTES
+
+
+def test_reutiliza_el_slab_mas_chico_que_alcanza(pool):
+    async def escenario():
+        chico = await pool.adquirir(1000)
+        grande = await pool.adquirir(3 * MIN_SLAB_BYTES)
+        pool.liberar(chico)
+        pool.liberar(grande)
+        return chico, grande, await pool.adquirir(500)
+
+    chico, grande, reusado = asyncio.run(escenario())
+    assert reusado is chico
+    assert pool.estadisticas()["created"] == 2
+    assert pool.estadisticas()["reused"] == 1
+
+
+def test_descarta_un_libre_para_no_pasar_el_maximo(pool):
+    async def escenario():
+        a = await pool.adquirir(1000)
+        b = await pool.adquirir(1000)
+        pool.liberar(a)
+        # Ningún libre alcanza y ya hay max_slabs vivos: se borra el libre
+        return b, await pool.adquirir(3 * MIN_SLAB_BYTES)
+
+    _, nuevo = asyncio.run(escenario())
+    stats = pool.estadisticas()
+    assert nuevo.size == 4 * MIN_SLAB_BYTES
+    assert stats["destroyed"] == 1
+    assert stats["free"] + stats["in_use"] == 2
+
+
+def test_semaforo_espera_a_que_se_libere_un_slab(pool):
+    async def escenario():
+        a = await pool.adquirir(1000)
+        await pool.adquirir(1000)
+        tercero = asyncio.create_task(pool.adquirir(1000))
+        await asyncio.sleep(0.01)
+        bloqueado = not tercero.done()
+        pool.liberar(a)
+        return bloqueado, await asyncio.wait_for(tercero, 1), a
+
+    bloqueado, tercero, a = asyncio.run(escenario())
+    assert bloqueado
+    assert tercero is a
+
+
+def test_liberar_dos_veces_no_agranda_el_pool(pool):
+    async def escenario():
+        a = await pool.adquirir(1000)
+        pool.liberar(a)
+        pool.liberar(a)
+        await pool.adquirir(1000)
+        await pool.adquirir(1000)
+        return asyncio.create_task(pool.adquirir(1000))
+
+    async def principal():
+        tercero = await escenario()
+        await asyncio.sleep(0.01)
+        bloqueado = not tercero.done()
+        tercero.cancel()
+        return bloqueado
+
+    assert asyncio.run(principal())
+
+
+def test_worker_lee_el_slab_sin_copiar(pool):
+    async def escenario():
+        return await pool.adquirir(64 * 64)
+
+    slab = asyncio.run(escenario())
+    gray = np.ndarray((64, 64), dtype=np.uint8, buffer=slab.buf)
+    gray[:] = np.arange(64, dtype=np.uint8)
+    descriptor = DescriptorImagen(slab.name, gray.shape, gray.dtype.str)
+    del gray
+    assert procesar_imagen(descriptor, lambda v: int(v[3].sum())) == sum(range(64))